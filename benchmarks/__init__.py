@@ -0,0 +1,4 @@
+""" Benchmarks for ts.py.  Run each one as a module from the repo root, e.g.
+
+    python -m benchmarks.startup
+"""
@@ -0,0 +1,176 @@
+""" Deterministic generator of realistic synthetic timesheets.
+
+    python -m benchmarks.generate [--years 3] [--seed 0] > big-hours.txt
+
+The same seed and options always produce the same file.  Besides ordinary
+entries (bill codes, range lists, bare hours, comments), the output has weekly
+`-----` summary markers, monthly `=====` invoice markers, free-form notes and
+malformed entry lines, which ts.py passes through untouched.
+"""
+import argparse, random, sys
+from datetime import date, timedelta
+
+BILLCODES = {
+    'IMPL': {'description': 'Implementation Work', 'rate': 120},
+    'ARCH': {'description': 'Architecture and Design Work', 'rate': 150},
+    'MEET': {'description': 'Meetings', 'rate': 100},
+    'SUPP': {'description': 'Support', 'rate': 90},
+}
+
+COMMENTS = [
+    'kickoff email', 'began work on the website', 'built testing framework',
+    'respond to analysis document', 'code review', 'deploy to staging',
+    'fixed login bug', 'weekly status call', 'performance tuning, round 2',
+    'wrote migration scripts', 'on-call: db failover',
+]
+
+NOTES = [
+    'Vacation next week.',
+    'TODO: ask about the Q3 budget',
+    '== Phase 2 ==',
+    'call with Bob re: scope',
+]
+
+MALFORMED = [
+    '{date} ~ lost track of time',
+    '{date} IMPL ??',
+    '{date} 9a to 5p',
+]
+
+FRONT_MATTER = """\
+client_name: Synthetic Client
+invoice_filename_template: invoice-synthetic-{invoice_code}.pdf
+address:
+  - Your Name
+  - Address Line 1
+footer:
+  - Thanks for your business.
+billcodes:
+"""
+
+
+def format_clock(minutes, suffix=True):
+    """
+    >>> format_clock(9 * 60), format_clock(13 * 60 + 30), format_clock(10 * 60 + 5, suffix=False)
+    ('9a', '1:30p', '10:05')
+    """
+    hour, minute = divmod(minutes, 60)
+    s = str((hour - 1) % 12 + 1)
+    if minute:
+        s += ':{:02d}'.format(minute)
+    if suffix:
+        s += 'a' if hour < 12 else 'p'
+    return s
+
+
+def format_duration(hours):
+    return '{:g}'.format(hours)
+
+
+def generate_ranges(r):
+    """ 1-4 ascending ranges within a working day, and their total hours. """
+    ranges, total = [], 0
+    t = r.randrange(7 * 4, 11 * 4) * 15
+    for i in range(r.choice([1, 1, 2, 2, 3, 4])):
+        length = r.randrange(1, 16) * 15
+        end = t + length
+        if end >= 23 * 60:
+            break
+        # ts.py reads a bare 7-11 as a.m., so the suffix can be left off.
+        start_s = format_clock(t, suffix=not (7 * 60 <= t < 12 * 60 and r.random() < .5))
+        s = '{}-{}'.format(start_s, format_clock(end))
+        if r.random() < .2:
+            s += '({})'.format(format_duration(length / 60.))
+        ranges.append(s)
+        total += length / 60.
+        t = end + r.randrange(1, 12) * 15
+    if r.random() < .05:
+        ranges.append('{}-'.format(format_clock(t)))
+    return ranges, total
+
+
+def generate_entry(r, d, billcodes):
+    date_s = d.isoformat() if r.random() < .8 else '{}/{}/{}'.format(d.month, d.day, d.year)
+    parts = [date_s]
+    if r.random() < .95:
+        parts.append(r.choice(billcodes))
+
+    k = r.random()
+    if k < .2:
+        parts.append(r.choice(['.25', '.5', '1', '1.5', '2', '4', '8']))
+    else:
+        ranges, total = generate_ranges(r)
+        if k < .3:
+            # Sometimes with a stated total, sometimes a stale one that ts.py fixes up.
+            parts.append(format_duration(total if r.random() < .7 else total + .5))
+        parts.append(', '.join(ranges))
+
+    line = '  '.join(parts)
+    if r.random() < .6:
+        line += ' # ' + r.choice(COMMENTS)
+    return line
+
+
+def generate_lines(seed=0, years=3, start=date(2015, 1, 5), billcodes=None):
+    """ Yield the lines (without newlines) of a synthetic timesheet.
+
+    >>> lines = list(generate_lines(seed=1, years=1))
+    >>> lines == list(generate_lines(seed=1, years=1))
+    True
+    >>> lines[lines.index('== Synthetic timesheet ==') + 2]
+    '1/5/2015  ARCH  10:30-1:15p, 3:15p-3:30p'
+    """
+    r = random.Random(seed)
+    if billcodes is None:
+        billcodes = sorted(BILLCODES)
+
+    yield from FRONT_MATTER.splitlines()
+    for code in billcodes:
+        info = BILLCODES.get(code, {'description': code, 'rate': 100})
+        yield '  {}:'.format(code)
+        yield '    description: {}'.format(info['description'])
+        yield '    rate: {}'.format(info['rate'])
+    yield '----'
+    yield ''
+    yield '== Synthetic timesheet =='
+    yield ''
+
+    invoice_number = 1
+    d = start
+    end = start + timedelta(days=int(365.25 * years))
+    while d < end:
+        weekday = d.weekday()
+        if weekday < 5 or r.random() < .1:
+            for i in range(r.choice([1, 1, 1, 1, 2])):
+                k = r.random()
+                if k < .02:
+                    yield r.choice(NOTES)
+                elif k < .04:
+                    yield r.choice(MALFORMED).format(date=d.isoformat())
+                else:
+                    yield generate_entry(r, d, billcodes)
+
+        next_d = d + timedelta(days=1)
+        if next_d.month != d.month:
+            yield '=====  # INV{:04d}, Work for {:%B %Y}.'.format(invoice_number, d)
+            yield ''
+            invoice_number += 1
+        elif weekday == 6:
+            yield '-----'
+            yield ''
+        d = next_d
+
+
+def generate(seed=0, years=3, **kwargs):
+    """ A synthetic timesheet, as one string. """
+    return ''.join(line + '\n' for line in generate_lines(seed, years, **kwargs))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic timesheet to stdout')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--years', type=float, default=3)
+    args = parser.parse_args()
+
+    for line in generate_lines(args.seed, args.years):
+        sys.stdout.write(line + '\n')
@@ -0,0 +1,261 @@
+""" Throughput and peak-memory benchmarks for ts.py, on a synthetic timesheet.
+
+    python -m benchmarks.run [--years 10] [--repeat 5] [BENCHMARK ...]
+    python -m benchmarks.run --save benchmarks/baseline.json
+    python -m benchmarks.run --compare benchmarks/baseline.json [--tolerance 0.2]
+
+Each benchmark is timed best-of --repeat, then run once more under tracemalloc
+for its peak memory.  With --compare, exits with status 1 if any benchmark's
+throughput dropped, or its peak memory grew, by more than --tolerance.
+Baselines are only comparable on the same machine and Python.
+"""
+import argparse, io, json, logging, platform, sys, time, tracemalloc
+from contextlib import redirect_stdout
+from datetime import datetime
+
+import ts
+from benchmarks.generate import generate
+
+TOLERANCE = 0.2
+
+# Benchmarks of a single call repeat it this many times, to get a measurable run.
+SMALL_CALLS = 20
+
+
+def quiet(fn):
+    """ Run fn() with stdout discarded. """
+    with redirect_stdout(io.StringIO()):
+        return fn()
+
+
+def clear_caches():
+    """ Forget memoized dates and times, so each repetition starts cold. """
+    for fn in (ts.parse_date, ts.decode_clock, ts.clock_on):
+        fn.cache_clear()
+
+
+def entry_lines(text, settings):
+    entries = []
+    for line in text.splitlines():
+        try:
+            if ts.parse(line, settings) is not None:
+                entries.append(line)
+        except (ts.TimesheetSyntaxError, ValueError):
+            pass
+    return entries
+
+
+# Each setup function takes the synthetic timesheet text and returns
+# (unit, run), where run() does the work and returns how many units it did.
+
+def setup_parse(text):
+    settings = ts.get_default_settings()
+    lines = entry_lines(text, settings)
+
+    def run():
+        clear_caches()
+        for line in lines:
+            ts.parse(line, settings)
+        return len(lines)
+    return 'lines', run
+
+
+def setup_parse_time(text):
+    settings = ts.get_default_settings()
+    calls = []
+    for line in entry_lines(text, settings):
+        _, date_s, _, _, ranges, _ = ts.scan_line(line.rstrip())
+        cur_date = ts.parse_date(date_s)
+        for start, end, _ in ranges or ():
+            if start is not None:
+                after = ts.parse_time(cur_date, start)
+                calls.append((cur_date, start, None))
+                if end is not None:
+                    calls.append((cur_date, end, after))
+
+    def run():
+        clear_caches()
+        for cur_date, time_str, after in calls:
+            ts.parse_time(cur_date, time_str, after=after)
+        return len(calls)
+    return 'calls', run
+
+
+def setup_format_ret(text):
+    settings = ts.get_default_settings()
+    items = [ts.parse(line, settings) for line in entry_lines(text, settings)]
+
+    def run():
+        for item in items:
+            ts.format_ret(item)
+        return len(items)
+    return 'lines', run
+
+
+def setup_process_timesheet(text):
+    lines = text.count('\n')
+
+    def run():
+        clear_caches()
+        quiet(lambda: ts.process_timesheet(io.StringIO(text), io.StringIO(), parse_jobs=1))
+        return lines
+    return 'lines', run
+
+
+def setup_load_front_matter(text):
+    front_matter = text[:text.index('\n----\n') + 6]
+
+    def run():
+        with redirect_stdout(io.StringIO()):
+            for _ in range(SMALL_CALLS):
+                ts.load_front_matter(io.StringIO(front_matter))
+        return SMALL_CALLS
+    return 'calls', run
+
+
+def setup_draw_pdf(text):
+    import invoice
+    settings = quiet(lambda: ts.load_front_matter(io.StringIO(text)))[0]
+    codes = sorted(settings['billcodes'])
+    inv = invoice.Invoice('INV0001', [], settings['client_name'], invoice_date=datetime(2015, 2, 1),
+        footer=settings['footer'], body=['Work for January 2015.'], address=settings['address'])
+    for i, code in enumerate(codes):
+        billcode_data = settings['billcodes'][code]
+        inv.add_item(name=billcode_data['description'], qty=10.25 * (i + 1),
+            unit_price=billcode_data['rate'], description=billcode_data['description'])
+
+    def run():
+        for _ in range(SMALL_CALLS):
+            invoice.draw_pdf(io.BytesIO(), inv)
+        return SMALL_CALLS
+    return 'invoices', run
+
+
+BENCHMARKS = {
+    'parse': setup_parse,
+    'parse_time': setup_parse_time,
+    'format_ret': setup_format_ret,
+    'process_timesheet': setup_process_timesheet,
+    'load_front_matter': setup_load_front_matter,
+    'draw_pdf': setup_draw_pdf,
+}
+
+
+def measure(run, repeat):
+    """ Returns (units, best seconds, peak traced bytes). """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        units = run()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return units, best, peak
+
+
+def run_benchmarks(names, text, repeat=5):
+    """ Returns {name: result dict}, with an 'error' instead for benchmarks that failed. """
+    results = {}
+    for name in names:
+        try:
+            unit, run = BENCHMARKS[name](text)
+            units, seconds, peak = measure(run, repeat)
+        except Exception as e:
+            results[name] = {'error': '{}: {}'.format(type(e).__name__, e)}
+            continue
+        results[name] = {'unit': unit, 'units': units, 'seconds': seconds,
+            'throughput': units / seconds, 'peak_bytes': peak}
+    return results
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """ Regressions against baseline results, as a list of messages.
+
+    >>> compare({'parse': {'throughput': 70., 'peak_bytes': 100}}, {'parse': {'throughput': 100., 'peak_bytes': 100}})
+    ['parse: throughput 70 is 30% below baseline 100']
+    >>> compare({'parse': {'throughput': 90., 'peak_bytes': 150}}, {'parse': {'throughput': 100., 'peak_bytes': 100}})
+    ['parse: peak memory 150 bytes is 50% above baseline 100 bytes']
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None or 'error' in base or 'error' in result:
+            continue
+        change = result['throughput'] / base['throughput'] - 1
+        if change < -tolerance:
+            regressions.append('{}: throughput {:.0f} is {:.0%} below baseline {:.0f}'.format(
+                name, result['throughput'], -change, base['throughput']))
+        change = result['peak_bytes'] / max(base['peak_bytes'], 1) - 1
+        if change > tolerance:
+            regressions.append('{}: peak memory {} bytes is {:.0%} above baseline {} bytes'.format(
+                name, result['peak_bytes'], change, base['peak_bytes']))
+    return regressions
+
+
+def format_table(results, baseline=None):
+    rows = []
+    for name, result in results.items():
+        if 'error' in result:
+            rows.append('{:<18} {}'.format(name, result['error']))
+            continue
+        row = '{:<18} {:>12,.0f} {:<9} {:>8.3f}s {:>9.1f}MB'.format(name, result['throughput'], result['unit'] + '/s',
+            result['seconds'], result['peak_bytes'] / 1e6)
+        base = (baseline or {}).get(name)
+        if base and 'error' not in base:
+            row += ' {:+7.1%}'.format(result['throughput'] / base['throughput'] - 1)
+        rows.append(row)
+    return '\n'.join(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark ts.py on a synthetic timesheet')
+    parser.add_argument('benchmarks', metavar='BENCHMARK', nargs='*', help='Defaults to all of: ' + ', '.join(BENCHMARKS))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--years', type=float, default=10, help='Size of the synthetic timesheet.')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--save', metavar='FILE', help='Save the results as a baseline.')
+    parser.add_argument('--compare', metavar='FILE', help='Compare against a saved baseline.')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+        help='Allowed fractional regression for --compare. Defaults to {}.'.format(TOLERANCE))
+    args = parser.parse_args()
+
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark {!r}'.format(name))
+
+    # ts.py logs a warning for every line it fixes up; keep them off the terminal.
+    ts.logger.addHandler(logging.NullHandler())
+    ts.logger.propagate = False
+
+    text = generate(args.seed, args.years)
+    results = run_benchmarks(args.benchmarks or list(BENCHMARKS), text, args.repeat)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            saved = json.load(f)
+        if saved['generator'] != {'seed': args.seed, 'years': args.years}:
+            print('! baseline was made with {}, not seed={} years={}'.format(saved['generator'], args.seed, args.years))
+        baseline = saved['results']
+
+    print('{} lines, {:.1f}MB'.format(text.count('\n'), len(text) / 1e6))
+    print(format_table(results, baseline))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'generator': {'seed': args.seed, 'years': args.years}, 'python': platform.python_version(),
+                'results': results}, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        for message in regressions:
+            print('! ' + message)
+        if regressions:
+            sys.exit(1)
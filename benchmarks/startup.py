@@ -0,0 +1,73 @@
+""" Check that `import ts` stays cheap, using `python -X importtime`.
+
+Editor hooks run ts.py on every save, so importing it must not load the
+modules that only invoices, YAML front matter or parallel runs need.
+
+    python -m benchmarks.startup [--budget-ms 150] [--own-budget-ms 25] [--runs 5]
+
+Exits with status 1 if the best of the runs is over either budget, or if any
+of LAZY_MODULES was imported.
+"""
+import argparse, os, py_compile, re, subprocess, sys
+
+# The whole import, standard library included, is typically 40-60ms, but
+# swings with machine load, so its budget only catches gross regressions
+# (heavy imports are caught by LAZY_MODULES anyway).  The budget for ts.py's
+# own module-level work (about 7ms) is the tight one: it is what lazy
+# initialisation controls, and it varies far less.  Both assume ts.py's
+# bytecode is cached, as it is for an editor hook after the first run;
+# compiling ts.py itself costs another ~45ms, so it is done up front.
+STARTUP_BUDGET_MS = 150
+OWN_BUDGET_MS = 25
+
+# Top-level modules that `import ts` must not pull in.
+LAZY_MODULES = ('reportlab', 'dateutil', 'yaml', 'modgrammar', 'invoice', 'grammar',
+    'concurrent', 'multiprocessing')
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORTTIME_REGEX = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \| *(\S+)')
+
+
+def import_times(module='ts'):
+    """ Import module in a fresh interpreter, returning [(self_us, cumulative_us, name)]. """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        cwd=REPO_ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    times = []
+    for line in result.stderr.splitlines():
+        m = IMPORTTIME_REGEX.match(line)
+        if m:
+            times.append((int(m.group(1)), int(m.group(2)), m.group(3)))
+    return times
+
+
+def check_startup(runs=5, module='ts'):
+    """ Returns (best cumulative ms, best ms of module's own, lazily-loaded
+    modules that were imported anyway).
+    """
+    py_compile.compile(os.path.join(REPO_ROOT, module + '.py'))
+    best = best_own = None
+    for _ in range(runs):
+        times = import_times(module)
+        own, total = next((own / 1000., total / 1000.) for own, total, name in times if name == module)
+        best = total if best is None else min(best, total)
+        best_own = own if best_own is None else min(best_own, own)
+    eager = sorted({name.split('.')[0] for _, _, name in times} & set(LAZY_MODULES))
+    return best, best_own, eager
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the import time of ts.py')
+    parser.add_argument('--budget-ms', type=float, default=STARTUP_BUDGET_MS)
+    parser.add_argument('--own-budget-ms', type=float, default=OWN_BUDGET_MS,
+        help="Budget for ts.py's own module-level work, without the modules it imports.")
+    parser.add_argument('--runs', type=int, default=5, help='Take the best of this many runs.')
+    args = parser.parse_args()
+
+    best, best_own, eager = check_startup(args.runs)
+    print("import ts: {:.1f}ms (budget {:.0f}ms), of which ts.py itself {:.1f}ms (budget {:.0f}ms)".format(
+        best, args.budget_ms, best_own, args.own_budget_ms))
+    for name in eager:
+        print("! {} was imported eagerly".format(name))
+    if best > args.budget_ms or best_own > args.own_budget_ms or eager:
+        sys.exit(1)
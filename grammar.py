@@ -0,0 +1,63 @@
+""" modgrammar definition of a timesheet line.
+
+This is the reference grammar; ts.scan_line() implements the same language with
+a compiled regex, and only falls back to this module with --parser=grammar.
+
+>>> myparser.parse_text("5/20/2015", reset=True, eof=True)
+MyGrammar<'5/20/2015'>
+"""
+from modgrammar import *
+
+grammar_whitespace_mode = 'explicit'
+
+class MyDate(Grammar):
+    # grammar = (WORD('0-9', "-0-9/", grammar_name='date'))
+    grammar = (WORD('2', "-0-9", fullmatch=True, grammar_name='date')
+        | WORD('0-9', "-0-9/", grammar_name='date'))
+    grammar_tags = ['date']
+
+class BillCode(Grammar):
+    """ All capital letter billing code. """
+    grammar = (WORD("A-Z", grammar_name='bill_code'))
+
+class Hours(Grammar):
+    grammar = (WORD(".0-9", grammar_name='hours'), OPTIONAL("h"))
+
+class Hour(Grammar):
+    grammar = WORD("0-9", min=1, max=2, grammar_name='hour')
+
+class Minute(Grammar):
+    grammar = WORD("0-9", min=1, max=2, grammar_name='minute')
+
+class AMPM(Grammar):
+    grammar = L("A") | L("P") | L("a") | L("p")
+
+class MyTime(Grammar):
+    grammar = (G(Hour, OPTIONAL(":", Minute))), OPTIONAL(AMPM)
+    # grammar = (WORD("0-9:", grammar_name='time'), OPTIONAL(L("A") | L("P") | L("a") | L("p"), grammar_name='ampm'))
+
+class Range(Grammar):
+    grammar = G(MyTime, OPTIONAL(WHITESPACE), '-', OPTIONAL(WHITESPACE),
+        OPTIONAL(MyTime), OPTIONAL('(', Hours, ')'), grammar_name='range')
+
+class RangeList(Grammar):
+    grammar = LIST_OF(G(Range | Hours), sep=G(",", OPTIONAL(WHITESPACE)), grammar_name="ranges")
+
+class Prefix(Grammar):
+    grammar = (ZERO_OR_MORE(L('*') | WHITESPACE), )
+
+class Suffix(Grammar):
+    grammar = (OPTIONAL(WHITESPACE), OPTIONAL(L('#'), REST_OF_LINE), EOF)
+
+class MyGrammar (Grammar):
+    grammar = (
+        G(Prefix, MyDate, WHITESPACE, Hours, WHITESPACE, RangeList, Suffix, grammar_name="3args") |
+        G(Prefix, MyDate, WHITESPACE, RangeList,  Suffix, grammar_name="2argrange") |
+        G(Prefix, MyDate, WHITESPACE, Hours, Suffix, grammar_name="2arghours") |
+        G(Prefix, MyDate, WHITESPACE, BillCode, WHITESPACE, Hours, WHITESPACE, RangeList, Suffix, grammar_name="3args") |
+        G(Prefix, MyDate, WHITESPACE, BillCode, WHITESPACE, RangeList,  Suffix, grammar_name="2argrange") |
+        G(Prefix, MyDate, WHITESPACE, BillCode, WHITESPACE, Hours, Suffix, grammar_name="2arghours") |
+        G(Prefix, MyDate, Suffix, grammar_name="justdate")
+    )
+
+myparser = MyGrammar.parser()
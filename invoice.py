@@ -8,6 +8,10 @@ from reportlab.platypus import Table
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.units import cm
 
+# Bump whenever the layout in draw_pdf() changes, so fingerprinted invoices get redrawn.
+LAYOUT_VERSION = 1
+FINGERPRINT_KEYWORD = 'ts-fingerprint:'
+
 def generate_invoice():
     p = canvas.Canvas("out.pdf")
     p.drawString(100, 100, "Hello world.")
@@ -89,12 +93,8 @@ address_func = draw_address
 footer_func = draw_footer
 
 
-def draw_pdf(buffer, invoice):
-    """ Draws the invoice """
-    canvas = Canvas(buffer, pagesize=A4)
-    canvas.translate(0, 29.7 * cm)
-    canvas.setFont('Helvetica', 10)
-
+def draw_static(canvas, invoice):
+    """ Draws what is the same on every page for a business: the header, footer and address """
     canvas.saveState()
     header_func(canvas)
     canvas.restoreState()
@@ -107,6 +107,9 @@ def draw_pdf(buffer, invoice):
     address_func(canvas, invoice.address)
     canvas.restoreState()
 
+
+def draw_invoice(canvas, invoice):
+    """ Draws the client address, invoice details and items """
     # Client address
     textobject = canvas.beginText(1.5 * cm, -2.5 * cm)
     for line in invoice.client_business_details:
@@ -158,13 +161,58 @@ def draw_pdf(buffer, invoice):
     tw, th, = table.wrapOn(canvas, 15 * cm, 19 * cm)
     table.drawOn(canvas, 1 * cm, -10 * cm - th)
 
+
+def start_page(canvas):
+    canvas.translate(0, 29.7 * cm)
+    canvas.setFont('Helvetica', 10)
+
+
+def draw_pdf(buffer, invoice):
+    """ Draws the invoice """
+    canvas = Canvas(buffer, pagesize=A4)
+    if invoice.fingerprint:
+        canvas.setKeywords(FINGERPRINT_KEYWORD + invoice.fingerprint)
+    start_page(canvas)
+    draw_static(canvas, invoice)
+    draw_invoice(canvas, invoice)
+
     canvas.showPage()
     canvas.save()
 
+
+def draw_pdfs(buffer, invoices, fingerprint=None):
+    """ Draws many invoices into one PDF, a page each.
+
+    The static layer (draw_static) is drawn once for each different footer
+    and address, as a form that every page using it just refers to, so pages
+    after the first cost little more than their table, and fonts and forms
+    are stored once for the whole file.
+    """
+    canvas = Canvas(buffer, pagesize=A4)
+    if fingerprint:
+        canvas.setKeywords(FINGERPRINT_KEYWORD + fingerprint)
+    forms = {}
+    for invoice in invoices:
+        key = (None if invoice.footer is None else tuple(invoice.footer),
+            None if invoice.address is None else tuple(invoice.address))
+        name = forms.get(key)
+        if name is None:
+            name = forms[key] = 'static{}'.format(len(forms))
+            canvas.beginForm(name)
+            start_page(canvas)
+            draw_static(canvas, invoice)
+            canvas.endForm()
+
+        canvas.doForm(name)
+        start_page(canvas)
+        draw_invoice(canvas, invoice)
+        canvas.showPage()
+    canvas.save()
+
 class Invoice():
     def __init__(self, id, client_business_details, client_name,
         invoice_date=datetime.datetime.now(),
-        currency='USD', body=None, footer=None, address=None):
+        currency='USD', body=None, footer=None, address=None, fingerprint=None):
         self.invoice_id = id
         self.invoice_date = invoice_date
         self.client = client_name
@@ -174,6 +222,7 @@ class Invoice():
         self.footer = footer
         self.body_text = body
         self.address = address
+        self.fingerprint = fingerprint
 
     def total(self):
         return sum([i.total() for i in self.items])
@@ -188,6 +237,15 @@ class Invoice():
             raise NotImplementedError("only .pdf")
 
 
+def has_fingerprint(out_filepath, fingerprint):
+    """ Whether the PDF at out_filepath was drawn with the given fingerprint. """
+    try:
+        with open(out_filepath, 'rb') as f:
+            return (FINGERPRINT_KEYWORD + fingerprint).encode('ascii') in f.read()
+    except IOError:
+        return False
+
+
 class Item(object):
     def __init__(self, name, qty, unit_price, description = ''):
         self.name = name
@@ -1,15 +1,17 @@
-import logging, re, os, shutil, sys
+import contextvars, copy, hashlib, io, json, logging, re, os, shutil, struct, sys, threading, time, traceback
+from array import array
+from contextlib import ExitStack, contextmanager, redirect_stdout
 from datetime import date, datetime
-from dataclasses import dataclass
-from collections import defaultdict
+from dataclasses import dataclass, field
+from functools import lru_cache
+from itertools import chain, islice, repeat
+from collections import defaultdict, deque
 from os.path import expanduser
 from typing import List, Optional
 
-from dateutil.parser import parse as dateutil_parse
-from modgrammar import *
-import yaml
-
-from invoice import Invoice
+# ReportLab, dateutil, YAML, modgrammar and multiprocessing are imported where
+# they are used, so that a run which never needs them doesn't pay to load them.
+# benchmarks/startup.py keeps an eye on this.
 
 
 def get_default_settings():
@@ -20,6 +22,7 @@ def get_default_settings():
         'footer': [],
         'prefix': '',
         'invoice_on': 'marker',
+        'parser': 'fast',
         'invoice_marker': '====',
         'summary_on': 'marker',
         'summary_marker': '----',
@@ -67,65 +70,178 @@ class TimesheetLineItem:
 # class TimesheetSummary:
 #     hours:
 
-logging.basicConfig(level=logging.DEBUG)
-
 logger = logging.getLogger(__name__)
 
-grammar_whitespace_mode = 'explicit'
+# The compiled line scanner below accepts exactly the language of MyGrammar,
+# trying the same alternatives in the same order, but in a single regex pass
+# without building a modgrammar parse tree.
+_WS = r'\s+'
+_HOURS = r'[.0-9]+h?'
+_TIME = r'[0-9]{1,2}(?::[0-9]{1,2})?[AaPp]?'
+_RANGE = r'{t}\s*-\s*(?:{t})?(?:\({h}\))?'.format(t=_TIME, h=_HOURS)
+_RANGE_ITEM = r'(?:{r}|{h})'.format(r=_RANGE, h=_HOURS)
+_RANGE_LIST = r'{i}(?:,\s*{i})*'.format(i=_RANGE_ITEM)
+_BILLCODE = r'[A-Z]+'
+
+LINE_PATTERN = (
+    r'(?P<prefix>[*\s]*)(?P<date>[0-9][-0-9/]*)(?:' +
+    r'|'.join([
+        r'{ws}(?P<h1>{h}){ws}(?P<r1>{rl})',
+        r'{ws}(?P<r2>{rl})',
+        r'{ws}(?P<h3>{h})',
+        r'{ws}(?P<b4>{b}){ws}(?P<h4>{h}){ws}(?P<r4>{rl})',
+        r'{ws}(?P<b5>{b}){ws}(?P<r5>{rl})',
+        r'{ws}(?P<b6>{b}){ws}(?P<h6>{h})',
+        r'',
+    ]).format(ws=_WS, h=_HOURS, rl=_RANGE_LIST, b=_BILLCODE) +
+    r')(?P<suffix>\s*(?:#[^\r\n\f\v\x85\u2028\u2029]*)?)')
+RANGE_ITEM_PATTERN = r'(?P<s>{t})\s*-\s*(?P<e>{t})?(?:\({h}\))?|(?P<hours>{h})'.format(t=_TIME, h=_HOURS)
+
+@lru_cache(maxsize=None)
+def line_regexes():
+    """ LINE_PATTERN and RANGE_ITEM_PATTERN, compiled on first use rather than by `import ts`. """
+    return re.compile(LINE_PATTERN), re.compile(RANGE_ITEM_PATTERN)
+
+
+class TimesheetSyntaxError(Exception):
+    """ The line is not a timesheet entry, and should be passed through as-is. """
+    pass
 
-class MyDate(Grammar):
-    # grammar = (WORD('0-9', "-0-9/", grammar_name='date'))
-    grammar = (WORD('2', "-0-9", fullmatch=True, grammar_name='date')
-        | WORD('0-9', "-0-9/", grammar_name='date'))
-    grammar_tags = ['date']
 
-class BillCode(Grammar):
-    """ All capital letter billing code. """
-    grammar = (WORD("A-Z", grammar_name='bill_code'))
+def scan_line(line):
+    """ Split a line into the raw text of its fields.
 
-class Hours(Grammar):
-    grammar = (WORD(".0-9", grammar_name='hours'), OPTIONAL("h"))
+    Returns (prefix, date, billcode, hours, ranges, suffix), where ranges is
+    None or a list of (start, end, hours) strings, with start/end None for
+    bare hours.
 
-class Hour(Grammar):
-    grammar = WORD("0-9", min=1, max=2, grammar_name='hour')
+    >>> scan_line('* 2015-06-03 ARCH 1.5  10a-11:15a, .5 # yo')
+    ('* ', '2015-06-03', 'ARCH', '1.5', [('10a', '11:15a', None), (None, None, '.5')], ' # yo')
+    >>> scan_line('2015-06-03 ARCH')
+    Traceback (most recent call last):
+        ...
+    ts.TimesheetSyntaxError: 2015-06-03 ARCH
+    """
+    line_regex, range_item_regex = line_regexes()
+    m = line_regex.fullmatch(line)
+    if m is None:
+        raise TimesheetSyntaxError(line)
+
+    prefix, date_s, h1, r1, r2, h3, b4, h4, r4, b5, r5, b6, h6, suffix = m.groups()
+    billcode = b4 or b5 or b6
+    hours = h1 or h3 or h4 or h6
+    range_list = r1 or r2 or r4 or r5
+
+    ranges = None
+    if range_list is not None:
+        ranges = []
+        for item in range_list.split(','):
+            r = range_item_regex.fullmatch(item.lstrip())
+            ranges.append(r.group('s', 'e', 'hours'))
+
+    return prefix, date_s, billcode, hours, ranges, suffix
+
+
+def scan_line_grammar(line):
+    """ Same as scan_line(), but using the modgrammar MyGrammar parser. """
+    from modgrammar import ParseError
+    from grammar import myparser, Prefix, MyDate, BillCode, Hours, RangeList, MyTime, Suffix
+    try:
+        origresult = myparser.parse_text(line, reset=True, eof=True) #, matchtype='longest')
+    except ParseError as e:
+        raise TimesheetSyntaxError(line) from e
+    result = origresult.elements[0]
 
-class Minute(Grammar):
-    grammar = WORD("0-9", min=1, max=2, grammar_name='minute')
+    def text(g):
+        return None if g is None else str(g)
 
-class AMPM(Grammar):
-    grammar = L("A") | L("P") | L("a") | L("p")
+    ranges = None
+    range_list = result.get(RangeList)
+    if range_list is not None:
+        ranges = []
+        for r in range_list.elements[0].elements:
+            if r.grammar_name == 'Hours':
+                ranges.append((None, None, str(r)))
+            elif r.grammar_name == 'Range':
+                times = r.find_all(MyTime)
+                if len(times)==1:
+                    ranges.append((str(times[0]), None, None))
+                elif len(times)==2:
+                    ranges.append((str(times[0]), str(times[1]), None))
+                else:
+                    raise Exception()
 
-class MyTime(Grammar):
-    grammar = (G(Hour, OPTIONAL(":", Minute))), OPTIONAL(AMPM)
-    # grammar = (WORD("0-9:", grammar_name='time'), OPTIONAL(L("A") | L("P") | L("a") | L("p"), grammar_name='ampm'))
+    return (text(result.get(Prefix)), text(result.get(MyDate)), text(result.get(BillCode)),
+        text(result.get(Hours)), ranges, text(result.get(Suffix)))
 
-class Range(Grammar):
-    grammar = G(MyTime, OPTIONAL(WHITESPACE), '-', OPTIONAL(WHITESPACE),
-        OPTIONAL(MyTime), OPTIONAL('(', Hours, ')'), grammar_name='range')
 
-class RangeList(Grammar):
-    grammar = LIST_OF(G(Range | Hours), sep=G(",", OPTIONAL(WHITESPACE)), grammar_name="ranges")
+LINE_SCANNERS = {
+    'fast': scan_line,
+    'grammar': scan_line_grammar,
+}
 
-class Prefix(Grammar):
-    grammar = (ZERO_OR_MORE(L('*') | WHITESPACE), )
+# Timesheets repeat the same few hundred dates and clock times constantly, so
+# decoding is memoized, with fast paths for the common formats and dateutil
+# as the fallback for anything unusual.
+DATE_CACHE_SIZE = 4096
+TIME_CACHE_SIZE = 4096
 
-class Suffix(Grammar):
-    grammar = (OPTIONAL(WHITESPACE), OPTIONAL(L('#'), REST_OF_LINE), EOF)
+ISO_DATE_REGEX = re.compile(r'([0-9]{4})-([0-9]{1,2})-([0-9]{1,2})')
+US_DATE_REGEX = re.compile(r'([0-9]{1,2})/([0-9]{1,2})/([0-9]{4})')
 
-class MyGrammar (Grammar):
-    grammar = (
-        G(Prefix, MyDate, WHITESPACE, Hours, WHITESPACE, RangeList, Suffix, grammar_name="3args") |
-        G(Prefix, MyDate, WHITESPACE, RangeList,  Suffix, grammar_name="2argrange") |
-        G(Prefix, MyDate, WHITESPACE, Hours, Suffix, grammar_name="2arghours") |
-        G(Prefix, MyDate, WHITESPACE, BillCode, WHITESPACE, Hours, WHITESPACE, RangeList, Suffix, grammar_name="3args") |
-        G(Prefix, MyDate, WHITESPACE, BillCode, WHITESPACE, RangeList,  Suffix, grammar_name="2argrange") |
-        G(Prefix, MyDate, WHITESPACE, BillCode, WHITESPACE, Hours, Suffix, grammar_name="2arghours") |
-        G(Prefix, MyDate, Suffix, grammar_name="justdate")
-    )
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def parse_date(date_str):
+    """ Parse date, as dateutil would.
 
-myparser = MyGrammar.parser()
+    >>> parse_date('2015-11-24')
+    datetime.date(2015, 11, 24)
+    >>> parse_date('5/20/2015')
+    datetime.date(2015, 5, 20)
+    >>> parse_date('20/5/2015')
+    datetime.date(2015, 5, 20)
+    >>> parse_date('20151124')
+    datetime.date(2015, 11, 24)
+    """
+    try:
+        m = ISO_DATE_REGEX.fullmatch(date_str)
+        if m:
+            return date(int(m.group(1)), int(m.group(2)), int(m.group(3)))
+        m = US_DATE_REGEX.fullmatch(date_str)
+        if m:
+            return date(int(m.group(3)), int(m.group(1)), int(m.group(2)))
+    except ValueError:
+        pass
+
+    from dateutil.parser import parse as dateutil_parse
+    return dateutil_parse(date_str).date()
 
 time_regex = re.compile(r'(\d{1,2})(:\d+)?([aApP])?')
+
+@lru_cache(maxsize=TIME_CACHE_SIZE)
+def decode_clock(time_str):
+    """ Decode 'h[:mm][ap]' into (hour, minute, 'a'|'p'|None), or None.
+
+    >>> decode_clock('12:45P')
+    (12, 45, 'p')
+    >>> decode_clock('9')
+    (9, 0, None)
+    """
+    m = time_regex.match(time_str)
+    if not m:
+        return None
+
+    g = m.groups()
+    hour = int(g[0])
+    minute = 0
+    if g[1] is not None:
+        minute = int(g[1][1:])
+    ampm = g[2].lower() if g[2] is not None else None
+    return hour, minute, ampm
+
+@lru_cache(maxsize=TIME_CACHE_SIZE)
+def clock_on(cur_date, hour, minute):
+    return datetime(cur_date.year, cur_date.month, cur_date.day, hour=hour, minute=minute)
+
 def parse_time(cur_date, time_str, after=None):
     """ Parse time
 
@@ -145,28 +261,23 @@ def parse_time(cur_date, time_str, after=None):
     datetime.datetime(2015, 6, 3, 0, 45)
     >>> parse_time(datetime(2015, 6, 3, 0, 0), '12:45p')
     datetime.datetime(2015, 6, 3, 12, 45)
+    >>> parse_time(date(2015, 6, 3), '9', after=datetime(2015, 6, 3, 10, 0))
+    datetime.datetime(2015, 6, 3, 21, 0)
     """
 
-    m = time_regex.match(time_str)
-    # print( "[parse_time]: " + time_str, m.groups())
-    if not m:
+    clock = decode_clock(time_str)
+    if clock is None:
         return None
 
-    g = m.groups()
-    # print(g)
-    hour = int(g[0])
-    minute = 0
-    if g[1] is not None:
-        minute = int(g[1][1:])
-
-    if g[2] is not None:
-        if hour != 12 and g[2] in ('p','P'):
+    hour, minute, ampm = clock
+    if ampm is not None:
+        if hour != 12 and ampm == 'p':
             hour += 12
-        elif hour == 12 and g[2] in ('a','A'):
+        elif hour == 12 and ampm == 'a':
             hour -= 12
     else:
         # AM/PM not specified.
-        time_as_am_guess = datetime(cur_date.year, cur_date.month, cur_date.day, hour=hour, minute=minute)
+        time_as_am_guess = clock_on(cur_date, hour, minute)
         if after is not None:
             if after > time_as_am_guess:
                 hour += 12
@@ -176,17 +287,24 @@ def parse_time(cur_date, time_str, after=None):
                 hour += 12
 
 
-    return datetime(cur_date.year, cur_date.month, cur_date.day, hour=hour, minute=minute)
+    return clock_on(cur_date, hour, minute)
 
 class TimesheetParseError(Exception):
     pass
 
-def parse(line, settings=None, prefix=None) -> Optional[TimesheetLineItem]:
+class InvoiceError(Exception):
+    pass
+
+class FrontMatterError(TimesheetParseError):
+    pass
+
+def parse(line, settings=None, prefix=None, *, scanners=LINE_SCANNERS, parse_date=parse_date,
+        parse_time=parse_time) -> Optional[TimesheetLineItem]:
     """ Parse grammar.
-    >>> myparser.parse_text("5/20/2015", reset=True, eof=True)
-    MyGrammar<'5/20/2015'>
     >>> parse("5/20/2015", prefix='')
-    TimesheetLineItem(date=datetime.date(2015, 5, 20), prefix=Prefix<''>, suffix=Suffix<None, None, ''>, billcode=None, hours=None, ranges=None)
+    TimesheetLineItem(date=datetime.date(2015, 5, 20), prefix='', suffix='', billcode=None, hours=None, ranges=None)
+    >>> parse("5/20/2015", {**get_default_settings(), 'parser': 'grammar'}, prefix='')
+    TimesheetLineItem(date=datetime.date(2015, 5, 20), prefix='', suffix='', billcode=None, hours=None, ranges=None)
     >>> d = parse("6/21/2015 1.25  3:33-4:44a", prefix='')
     Traceback (most recent call last):
         ...
@@ -222,43 +340,26 @@ def parse(line, settings=None, prefix=None) -> Optional[TimesheetLineItem]:
         return None
 
     line = line.rstrip()
-    origresult = myparser.parse_text(line, reset=True, eof=True) #, matchtype='longest')
-    result = origresult.elements[0]
-
-    date_g = result.get(MyDate)
-    if date_g is None:
-        return None
+    scan = scanners[settings.get('parser', 'fast')]
+    prefix_s, date_s, billcode, hours_s, ranges, suffix = scan(line)
 
-    cur_date = dateutil_parse(str(date_g)).date()
+    cur_date = parse_date(date_s)
     ret = TimesheetLineItem(date=cur_date)
-    ret.prefix = result.get(Prefix)
-    ret.suffix = result.get(Suffix)
-    ret.billcode = result.get(BillCode)
+    ret.prefix = prefix_s
+    ret.suffix = suffix
+    ret.billcode = billcode
 
-    hours_g = result.get(Hours)
-    if hours_g is not None:
-        ret.hours = float(str(hours_g))
+    if hours_s is not None:
+        ret.hours = float(hours_s)
 
-    ranges = result.get(RangeList)
     if ranges is not None:
         ret.ranges = []
-        # logger.debug(ranges.elements)
 
-        for r in ranges.elements[0].elements:
-            if r.grammar_name == 'Hours':
-                duration = float(str(r))
+        for start, end, hours_s in ranges:
+            if start is None:
+                duration = float(hours_s)
                 ret.ranges.append( {'duration': duration} )
-            elif r.grammar_name == 'Range':
-                times = r.find_all(MyTime)
-                if len(times)==1:
-                    start = str(times[0])
-                    end = None
-                elif len(times)==2:
-                    start = str(times[0])
-                    end = str(times[1])
-                else:
-                    raise Exception()
-
+            else:
                 try:
                     parsed_start = parse_time(cur_date, start)
                 except (ValueError, ):
@@ -280,8 +381,6 @@ def parse(line, settings=None, prefix=None) -> Optional[TimesheetLineItem]:
                 else:
                     duration = None
                 ret.ranges.append( {'s': parsed_start, 'e': parsed_end, 'duration': duration} )
-            else:
-                pass
 
 
     if ret.ranges is not None:
@@ -370,27 +469,65 @@ def format_ret(ret, settings=None):
     return '%s%s%s' % (ret.prefix, output, suffix)
 
 
+def load_yaml(stream):
+    """ yaml.safe_load(), with libyaml's C loader where PyYAML was built with it. """
+    import yaml
+    return yaml.load(stream, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+
+
+# Settings are layered: the defaults, then each of CONFIG_FILES that exists,
+# then the timesheet's own front matter.  All but the last are merged once
+# and kept until one of the files changes, so batch and watch runs only
+# stat them for each timesheet.
+CONFIG_FILES = ('~/.tsconfig.yml', 'default.yml')
+CONFIG_CACHE = {}
+
+def config_key():
+    """ Each config file's path, size and mtime (or None, if it's missing). """
+    key = []
+    for filename in CONFIG_FILES:
+        path = os.path.abspath(expanduser(filename))
+        try:
+            st = os.stat(path)
+            key.append((path, st.st_size, st.st_mtime_ns))
+        except OSError:
+            key.append((path, None))
+    return tuple(key)
+
+def load_config(log=print):
+    """ The default settings, updated from CONFIG_FILES. """
+    key = config_key()
+    settings = CONFIG_CACHE.get(key)
+    if settings is None:
+        settings = get_default_settings()
+        for filename, (path, *_) in zip(CONFIG_FILES, key):
+            try:
+                default_f = open(path)
+            except IOError:
+                log("'{}' not found, skipping...".format(expanduser(filename)))
+                continue
+
+            with default_f:
+                log("loading from '{}'...".format(expanduser(filename)))
+                settings.update(load_yaml(default_f))
+        CONFIG_CACHE.clear()
+        CONFIG_CACHE[key] = settings
+    return copy.deepcopy(settings)
+
+
 FRONT_MATTER_TERMINUS_REGEX = re.compile('^---+$')
 def load_front_matter(f):
     """ Load jekyll-style front-matter config from top of file.
     """
-    settings = get_default_settings()
-
-    def update_from_file(settings, filename):
-        try:
-            default_f = open(filename)
-        except IOError:
-            print("'{}' not found, skipping...".format(filename))
-            return
-
-        if default_f:
-            print("loading from '{}'...".format(filename))
-            default_yml_settings = yaml.safe_load(default_f)
-            settings.update(default_yml_settings)
-            default_f.close()
+    try:
+        return read_front_matter(f)
+    except FrontMatterError as exc:
+        print(exc)
+        sys.exit(1)
 
-    update_from_file(settings, expanduser('~/.tsconfig.yml'))
-    update_from_file(settings, 'default.yml')
+def read_front_matter(f, log=print):
+    """ load_front_matter(), raising FrontMatterError rather than exiting. """
+    settings = load_config(log)
 
     front_matter = []
     found=False
@@ -401,247 +538,2414 @@ def load_front_matter(f):
         front_matter.append(line)
 
     if not found:
-        print("Front-matter YAML is required.")
-        sys.exit(1)
+        raise FrontMatterError("Front-matter YAML is required.")
 
-    fm_settings = yaml.safe_load("".join(front_matter))
+    fm_settings = load_yaml("".join(front_matter))
     settings.update(fm_settings)
 
     return settings, front_matter
 
 
-def process_timesheet(f, outf, verbose=0, invoice=False):
-    global weekly_hours, invoice_hours
+# process_timesheet() is a chain of streaming stages connected by generators:
+#
+#   read -> classify_lines -> parse_lines -> aggregate_entries -> format_records -> write_lines
+#
+# Each stage holds only the state it needs, so memory stays flat however
+# long the timesheet is, and any stage (e.g. the sink) can be swapped out.
+
+# Line kinds produced by classify_lines() and parse_lines().
+BLANK = 'blank'
+TEXT = 'text'
+SUMMARY_MARKER = 'summary_marker'
+INVOICE_MARKER = 'invoice_marker'
+ENTRY = 'entry'
+
+# Record kinds produced by aggregate_entries().
+PASSTHROUGH = 'passthrough'
+SUMMARY = 'summary'
+
+
+class DateSet:
+    """ Set of dates, stored as a bitmap with one bit per day in the span seen.
+
+    >>> s = DateSet()
+    >>> s.add(date(2015, 6, 3)), s.add(date(2014, 1, 1)), s.add(date(2015, 6, 3))
+    (False, False, True)
+    >>> date(2014, 1, 1) in s, date(2014, 1, 2) in s
+    (True, False)
+    """
+    def __init__(self):
+        self.base = None
+        self.bits = bytearray()
+
+    def __contains__(self, d):
+        i = d.toordinal() - self.base if self.base is not None else -1
+        return 0 <= i < len(self.bits) * 8 and bool(self.bits[i >> 3] & (1 << (i & 7)))
+
+    def add(self, d):
+        """ Add a date, returning whether it was already present. """
+        ordinal = d.toordinal()
+        if self.base is None:
+            self.base = ordinal & ~7
+        if ordinal < self.base:
+            grow = (self.base - ordinal + 7) >> 3
+            self.bits[:0] = bytes(grow)
+            self.base -= grow * 8
+        i = ordinal - self.base
+        if (i >> 3) >= len(self.bits):
+            self.bits.extend(bytes((i >> 3) - len(self.bits) + 1))
+        present = bool(self.bits[i >> 3] & (1 << (i & 7)))
+        self.bits[i >> 3] |= 1 << (i & 7)
+        return present
+
+
+@dataclass
+class RunningTotals:
+    weekly_hours: float = 0.
+    invoice_hours: float = 0.
+    invoice_hours_per_code: dict = field(default_factory=lambda: defaultdict(int))
+    invoices: list = field(default_factory=list)
+    started: bool = False
+    last_date: Optional[date] = None
+    last_week: Optional[tuple] = None
+    seen_dates: DateSet = field(default_factory=DateSet)
+
+
+class SummaryTemplate:
+    """ A summary line template, remembering the last line it made.
+
+    In weekly mode every line of text is checked against the current summary
+    line, which only changes when the totals do.
+    """
+    def __init__(self, prefix, template):
+        self.format = (prefix + template).format
+        self.last = (None, None, None)
+
+    def __call__(self, weekly_hours, invoice_hours):
+        last_weekly_hours, last_invoice_hours, line = self.last
+        if weekly_hours != last_weekly_hours or invoice_hours != last_invoice_hours:
+            line = self.format(hours_this_week=format_hours(weekly_hours),
+                hours_since_invoice=format_hours(invoice_hours))
+            self.last = (weekly_hours, invoice_hours, line)
+        return line
+
+@lru_cache(maxsize=64)
+def summary_template(prefix, template):
+    return SummaryTemplate(prefix, template)
+
+def format_summary_line(totals, settings, invoice=False):
+    """
+    >>> format_summary_line(RunningTotals(weekly_hours=6.25, invoice_hours=26.5), get_default_settings())
+    '----------       6.25 (26.50 uninvoiced)'
+    """
+    if invoice:
+        template = settings['invoice_template']
+    else:
+        template = settings['weekly_summary_template']
+
+    return summary_template(settings['prefix'], template)(totals.weekly_hours, totals.invoice_hours)
+
 
-    summary_results = {}
-    last_date = None
-    last_iso = None
+def summarize(totals, settings, invoice=False, original_line=''):
+    """ Close out the week (and the invoice, if invoice=True).
 
-    invoice_has_started = False
-    weekly_hours = 0.
-    invoice_hours = 0.
-    invoice_hours_per_code = defaultdict(int)
+    Returns a SUMMARY record of (SUMMARY, summary_line, invoice_data), where
+    summary_line is None if there is nothing to summarize.
+    """
+    summary_line = format_summary_line(totals, settings, invoice=invoice)
+
+    original_line_split = original_line.split('#', 1)
+    comment = ''
+    if len(original_line_split)==2:
+        comment = original_line_split[-1].strip()
+        summary_line += ' # ' + comment
 
-    def format_summary_line():
-        # global weekly_hours, invoice_hours,
-        weekly_summary_template = settings['prefix'] + settings['weekly_summary_template']
-        return weekly_summary_template.format(
-            hours_this_week=format_hours(weekly_hours),
-            hours_since_invoice=format_hours(invoice_hours))
+    invoice_id, invoice_description = '', ''
+    try:
+        invoice_id, invoice_description = comment.split(',', 1)
+    except:
+        pass
+
+    invoice_data = None
+    if invoice:
+        invoice_data = {'id': invoice_id, 'hours': totals.invoice_hours, 'items': [], 'description': invoice_description.strip()}
+        for k,v in totals.invoice_hours_per_code.items():
+            invoice_data['items'].append({'billcode': k, 'hours': v})
+        totals.invoices.append(invoice_data)
+
+    if totals.weekly_hours != 0. or invoice:
+        totals.weekly_hours = 0.
 
-    def write_summary_line(invoice=False, original_line=''):
-        global weekly_hours, invoice_hours
         if invoice:
-            template = settings['invoice_template']
+            totals.invoice_hours = 0.
+            totals.invoice_hours_per_code.clear()
+    else:
+        summary_line = None
+
+    return SUMMARY, summary_line, invoice_data
+
+
+def classify_lines(lines, settings, log=print):
+    """ Tag each line as an invoice marker, blank, summary marker or text. """
+    verbose = settings['verbose']
+    invoice_marker = settings['invoice_marker'] if settings['invoice_on'] == 'marker' else None
+    summary_marker = settings['summary_marker'] if settings['summary_on'] == 'marker' else None
+
+    for line in lines:
+        if verbose >= 1:
+            log('< {}'.format(line.rstrip()))
+
+        if invoice_marker is not None and line.startswith(invoice_marker):
+            yield INVOICE_MARKER, line
+        elif line.strip() == '':
+            yield BLANK, line
+        elif summary_marker is not None and line.startswith(summary_marker):
+            yield SUMMARY_MARKER, line
         else:
-            template = settings['weekly_summary_template']
+            yield TEXT, line
+
 
-        summary_line = settings['prefix'] + template.format(
-            hours_this_week=format_hours(weekly_hours),
-            hours_since_invoice=format_hours(invoice_hours))
+def parse_lines(classified, settings, started=False, parse_line=parse, log=print):
+    """ Parse lines into (kind, line, TimesheetLineItem or None).
 
-        original_line_split = original_line.split('#', 1)
-        comment = ''
-        if len(original_line_split)==2:
-            comment = original_line_split[-1].strip()
-            summary_line += ' # ' + comment
+    Markers and blank lines only mean something once the first entry has been
+    seen; until then they are parsed (and passed through) like any other text.
+    """
+    for kind, line in classified:
+        if started and kind != TEXT:
+            yield kind, line, None
+            continue
 
-        invoice_id, invoice_description = '', ''
         try:
-            invoice_id, invoice_description = comment.split(',', 1)
-        except:
-            pass
+            ret = parse_line(line, settings)
+        except TimesheetParseError:
+            log("Problem parsing.")
+            raise
+        except TimesheetSyntaxError:
+            yield TEXT, line, None
+            continue
 
-        if invoice:
-            invoice_data = {'id': invoice_id, 'hours': invoice_hours, 'items': [], 'description': invoice_description.strip()}
-            for k,v in invoice_hours_per_code.items():
-                invoice_data['items'].append({'billcode': k, 'hours': v})
-            invoices.append(invoice_data)
+        if ret is None:
+            if settings['verbose'] >= 1 and line.strip() != '':
+                log("> Failed to parse. Writing straight.")
+            yield TEXT, line, None
+            continue
+
+        if not started and settings['verbose'] >= 1:
+            log("! Invoice has started!")
+        started = True
+        yield ENTRY, line, ret
+
+
+# parse() is a pure function of the line and settings, so for large files it
+# can run ahead on a process pool.  Only its results (and the warnings it
+# logs) are fed back into the sequential stages, in order.
+PARALLEL_PARSE_MIN_BYTES = 2 * 1024 * 1024
+PARALLEL_PARSE_CHUNK_LINES = 2000
+
+
+class WarningCollector(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append((record.levelno, record.getMessage()))
+
+
+def parse_chunk(lines, settings):
+    """ Worker: parse lines, returning (ret, exception, logged messages) for each. """
+    collector = WarningCollector()
+    logger.addHandler(collector)
+    propagate, logger.propagate = logger.propagate, False
+    outcomes = []
+    try:
+        for line in lines:
+            collector.messages = []
+            try:
+                outcomes.append((parse(line, settings), None, collector.messages))
+            except Exception as exc:
+                outcomes.append((None, exc, collector.messages))
+    finally:
+        logger.removeHandler(collector)
+        logger.propagate = propagate
+    return outcomes
+
+
+def use_parallel_parse(f, settings, jobs):
+    """ Parse in parallel if asked to (jobs > 1), or, by default, for big files. """
+    if jobs is not None:
+        return jobs > 1
+    if settings['verbose'] >= 2 or (os.cpu_count() or 1) < 2:
+        return False
+    try:
+        return os.fstat(f.fileno()).st_size >= PARALLEL_PARSE_MIN_BYTES
+    except (AttributeError, OSError, ValueError):
+        return False
 
-        if weekly_hours != 0. or invoice:
+
+class ParallelParser:
+    """ Parses lines ahead on a process pool.
+
+    read() is a source stage that passes lines through unchanged while
+    keeping a window of chunks in flight, and parse() is a drop-in
+    replacement for parse() in parse_lines(), which returns (or raises) the
+    precomputed result for the line most recently passed through.
+    """
+    def __init__(self, executor, jobs, chunk_lines=PARALLEL_PARSE_CHUNK_LINES):
+        self.executor = executor
+        self.window = 2 * jobs
+        self.chunk_lines = chunk_lines
+        self.outcome = None
+
+    def read(self, lines, settings):
+        lines = iter(lines)
+        pending = deque()
+        while True:
+            while len(pending) < self.window:
+                chunk = list(islice(lines, self.chunk_lines))
+                if not chunk:
+                    break
+                pending.append((chunk, self.executor.submit(parse_chunk, chunk, settings)))
+            if not pending:
+                return
+
+            chunk, future = pending.popleft()
+            for line, outcome in zip(chunk, future.result()):
+                self.outcome = outcome
+                yield line
+
+    def parse(self, line, settings):
+        ret, exc, messages = self.outcome
+        for level, message in messages:
+            logger.log(level, message)
+        if exc is not None:
+            raise exc
+        return ret
+
+
+def aggregate_entries(parsed, settings, totals, log=print):
+    """ Keep running totals, yielding ENTRY, PASSTHROUGH and SUMMARY records. """
+    for kind, line, ret in parsed:
+        if kind == INVOICE_MARKER:
+            yield summarize(totals, settings, invoice=True, original_line=line)
             if settings['verbose'] >= 1:
-                print(summary_line)
-            if outf:
-                outf.write(summary_line + '\n')
-            weekly_hours = 0.
+                log("> Wrote summary line")
+        elif kind == BLANK:
+            # Throw out empty lines
+            continue
+        elif kind == SUMMARY_MARKER:
+            # Just throw out old summary lines.. we'll write them again ourselves.
+            yield summarize(totals, settings, original_line=line)
+        elif kind == TEXT:
+            if totals.started and settings['summary_on'] != 'marker':
+                if line.startswith(format_summary_line(totals, settings)):
+                    continue
+            yield PASSTHROUGH, line
+        else:
+            totals.started = True
+            if totals.last_date is not None and totals.last_date > ret.date:
+                logger.warning('Date {} is listed after date {}.'.format(ret.date, totals.last_date))
+            if totals.seen_dates.add(ret.date):
+                logger.warning('Date {} listed multiple times.'.format(ret.date))
 
-            if invoice:
-                invoice_hours = 0.
-                invoice_hours_per_code.clear()
+            week = ret.date.isocalendar()[:2]
+            if settings['summary_on'] == 'weekly':
+                if totals.last_week is not None and week != totals.last_week:
+                    yield summarize(totals, settings)
 
-        if outf:
-            outf.write('\n')
+            totals.last_date = ret.date
+            totals.last_week = week
+            totals.weekly_hours += ret.hours
+            totals.invoice_hours += ret.hours
+            totals.invoice_hours_per_code[str(ret.billcode or '')] += ret.hours
 
-    def write_final_summary_line():
+            yield ENTRY, ret, line
 
+    yield summarize(totals, settings)
+
+
+def format_records(records, settings, format_entry=None, log=print):
+    """ Render records as output text. """
+    for record in records:
+        kind = record[0]
+        if kind == ENTRY:
+            if format_entry is not None:
+                fixed_line = format_entry(record[1], settings, record[2])
+            else:
+                fixed_line = format_ret(record[1], settings)
+            if settings['verbose'] >= 1:
+                log("> {}".format(fixed_line))
+            yield fixed_line.rstrip() + '\n'
+        elif kind == PASSTHROUGH:
+            yield record[1].rstrip() + '\n'
+        else:
+            summary_line = record[1]
+            if summary_line is not None:
+                if settings['verbose'] >= 1:
+                    log(summary_line)
+                yield summary_line + '\n'
+            yield '\n'
+
+
+def format_front_matter(raw_front_matter):
+    yield from raw_front_matter
+    # yaml.dump(settings, outf, default_flow_style=False)
+    yield '----\n'
+
+
+def write_lines(chunks, outf):
+    """ Sink: write chunks to a file-like object (or just drain them if None). """
+    for chunk in chunks:
         if outf:
-            outf.write('\n')
-        if outf:
-            outf.write('\n')
+            outf.write(chunk)
 
 
-    settings, raw_front_matter = load_front_matter(f)
-    if args.verbose is not None:
-        settings['verbose'] = args.verbose
+def invoice_filename(i, settings):
+    invoice_filename_template = settings['invoice_filename_template']
+    return invoice_filename_template.format(
+        invoice_code=i['id'],
+        client_name=settings['client_name']
+    )
 
-    # logger.info("settings {}".format(settings))
 
-    for line in raw_front_matter:
-        outf.write(line)
+# Settings that show up on an invoice, and so are part of its fingerprint.
+INVOICE_FINGERPRINT_SETTINGS = ('billcode', 'billcodes', 'address', 'footer', 'client_name')
 
-    # yaml.dump(settings, outf, default_flow_style=False)
-    outf.write('----\n')
+def invoice_fingerprint(i, settings):
+    """ Hash of everything that goes into an invoice PDF, other than its date. """
+    from invoice import LAYOUT_VERSION
+    data = [LAYOUT_VERSION, i, {k: settings.get(k) for k in INVOICE_FINGERPRINT_SETTINGS}]
+    text = json.dumps(data, sort_keys=True, default=str)
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
 
-    invoices = []
 
-    for line in f:
-        if settings['verbose'] >= 1:
-            print('< {}'.format(line.rstrip()))
+def make_invoice(i, settings, fingerprint=None):
+    """ An invoice.Invoice of one of a timesheet's invoices (totals.invoices). """
+    from invoice import Invoice
+    invoice = Invoice(i['id'], [], settings['client_name'], footer=settings['footer'], body=[i['description']], address=settings['address'],
+        fingerprint=fingerprint)
+    for item in i['items']:
+        if settings['billcode']:
+            billcode_data = settings['billcodes'][item['billcode']]
+        else:
+            billcode_data = settings['billcodes']['default']
 
-        try:
-            if invoice_has_started:
-                # Found an invoice marker, so rewrite it...
-                if settings['invoice_on'] == 'marker' and line.startswith(settings['invoice_marker']):
-                    write_summary_line(invoice=True, original_line=line)
-                    if settings['verbose'] >= 1:
-                        print("> Wrote summary line".format())
-                    continue
+        invoice.add_item(
+            name=billcode_data['description'],
+            qty=round(item['hours'], 2),
+            unit_price=billcode_data['rate'],
+            description=billcode_data['description'])
+    return invoice
 
-                # Throw out empty lines
-                if line.strip() == '':
-                    continue
 
-                # Just throw out old summary lines.. we'll write them again ourselves.
-                if settings['summary_on'] == 'marker':
-                    if line.startswith(settings['summary_marker']):
-                        write_summary_line(original_line=line)
-                        continue
-                else:
-                    if line.startswith(format_summary_line()):
-                        continue
+def render_invoice(i, settings, fingerprint=None):
+    """ Lay out and save one invoice PDF, returning its filename. """
+    filename = invoice_filename(i, settings)
+    make_invoice(i, settings, fingerprint).save(filename)
+    return filename
 
-            ret = parse(line, settings)
-            if ret is None:
-                if settings['verbose'] >= 1 and line.strip() != '':
-                    print("> Failed to parse. Writing straight.".format())
-                if outf:
-                    outf.write(line.rstrip() + '\n')
+
+def try_render_invoice(i, settings, fingerprint=None, render=render_invoice):
+    """ render(), returning (filename, None) or (None, formatted traceback). """
+    try:
+        return render(i, settings, fingerprint), None
+    except Exception:
+        return None, traceback.format_exc().rstrip()
+
+
+def write_invoices(invoices, settings, jobs=None, force=False, log=print, render=render_invoice):
+    """ Render invoice PDFs, on a process pool if there are several.
+
+    Invoices whose PDF already carries the same fingerprint are skipped,
+    unless force=True.  Every other invoice is attempted and reported, in
+    order; InvoiceError is raised at the end if any of them failed.
+    """
+    from invoice import has_fingerprint
+    fingerprints = [invoice_fingerprint(i, settings) for i in invoices]
+    changed = [force or not has_fingerprint(invoice_filename(i, settings), fingerprint)
+        for i, fingerprint in zip(invoices, fingerprints)]
+    todo = [(i, fingerprint) for i, fingerprint, c in zip(invoices, fingerprints, changed) if c]
+
+    if jobs is None:
+        jobs = min(len(todo), os.cpu_count() or 1)
+
+    with ExitStack() as stack:
+        if jobs > 1 and todo:
+            from concurrent.futures import ProcessPoolExecutor
+            executor = stack.enter_context(ProcessPoolExecutor(max_workers=jobs))
+            results = executor.map(try_render_invoice, [i for i, _ in todo], repeat(settings),
+                [fingerprint for _, fingerprint in todo])
+        else:
+            results = (try_render_invoice(i, settings, fingerprint, render) for i, fingerprint in todo)
+
+        failed = []
+        for i, c in zip(invoices, changed):
+            if not c:
+                log("Invoice {} is unchanged, skipping {}".format(i['id'], invoice_filename(i, settings)))
                 continue
 
-            if not invoice_has_started and settings['verbose'] >= 1:
-                print("! Invoice has started!")
-            invoice_has_started = True
-            if last_date is not None and last_date > ret.date:
-                logger.warning('Date {} is listed after date {}.'.format(ret.date, last_date))
-            if ret.date in summary_results:
-                logger.warning('Date {} listed multiple times.'.format(ret.date))
+            filename, error = next(results)
+            if error is None:
+                log("Wrote invoice to {}".format(filename))
+            else:
+                logger.error("Failed to write invoice {}:\n{}".format(i['id'], error))
+                failed.append(i['id'])
 
-            iso = ret.date.isocalendar()
-            if settings['summary_on'] == 'weekly':
-                if last_iso is not None and (iso[0] != last_iso[0] or iso[1] != last_iso[1]):
-                    write_summary_line()
+    if failed:
+        raise InvoiceError("Failed to write {} of {} invoices: {}".format(
+            len(failed), len(invoices), ", ".join(failed)))
 
-            last_date = ret.date
-            last_iso = iso
-            weekly_hours += ret.hours
-            invoice_hours += ret.hours
-            invoice_hours_per_code[str(ret.billcode or '')] += ret.hours
 
-            summary_results[ret.date] = ret
+# Columnar entry store.  A TimesheetLineItem with its range dicts and
+# datetimes costs several hundred bytes; an EntryStore row is a few dozen,
+# held in typed arrays: dates as ordinals, times as minutes past midnight,
+# and strings (billcodes, prefixes, comments, clients) interned as ids.
+NO_STRING = -1
+NO_RANGES = -1
+BOUNDARY_SUMMARY = 1
+BOUNDARY_INVOICE = 2
+RANGE_HOURS_ONLY = -1  # range_start of a bare duration, e.g. the '.25' in '.25, 1:30p-5p'
+TIME_MISSING = -2      # range_start/range_end of a time that isn't there, e.g. the end of '12p-'
 
-            fixed_line = format_ret(ret, settings)
-            if settings['verbose'] >= 1:
-                print(">", fixed_line)
-            if outf:
-                outf.write(fixed_line.rstrip() + '\n')
 
-        except TimesheetParseError:
-            print("Problem parsing.")
-            raise
-        except ParseError:
-            if outf:
-                outf.write(line.rstrip() + '\n')
+def to_minutes(t):
+    return TIME_MISSING if t is None else t.hour * 60 + t.minute
+
+
+def from_minutes(day, minutes):
+    return None if minutes == TIME_MISSING else datetime(day.year, day.month, day.day, minutes // 60, minutes % 60)
+
+
+def nan_to_none(x):
+    return None if x != x else x
+
+
+class EntryStore:
+    """ Parsed entries in typed arrays, one row per entry.
+
+    >>> store = EntryStore()
+    >>> store.append(parse('* 7/13/2015 3.5  .25, 1:30p-5p # call', prefix='* '), client='ACME')
+    >>> store.append(parse('2015-07-14 IMPL 2 # call', prefix=''))
+    >>> len(store), store.strings
+    (2, ['* ', ' # call', 'ACME', 'IMPL', ''])
+    >>> row = store[0]
+    >>> row.date, row.hours, row.billcode, row.client
+    (datetime.date(2015, 7, 13), 3.75, None, 'ACME')
+    >>> format_ret(row)
+    '* 2015-07-13       3.75 .25, 1:30p-5p(3.50) # call'
+    >>> store[1].to_item()
+    TimesheetLineItem(date=datetime.date(2015, 7, 14), prefix='', suffix=' # call', billcode='IMPL', hours=2.0, ranges=None)
+    """
+    def __init__(self):
+        self.dates = array('i')          # date.toordinal()
+        self.billcodes = array('i')      # string id, or NO_STRING
+        self.hours = array('d')          # NaN for None
+        self.prefixes = array('i')
+        self.suffixes = array('i')
+        self.clients = array('i')
+        self.range_offsets = array('i')  # row's first range, or NO_RANGES
+        self.range_counts = array('i')
+        self.range_starts = array('h')   # minutes past midnight
+        self.range_ends = array('h')
+        self.range_hours = array('d')
+        self.boundary_rows = array('i')  # number of entries before the marker
+        self.boundary_kinds = array('i')  # BOUNDARY_SUMMARY or BOUNDARY_INVOICE
+        self.boundary_labels = array('i')  # string id of the marker's comment
+        self.strings = []
+        self.string_ids = {}
+
+    def intern(self, s):
+        if s is None:
+            return NO_STRING
+        string_id = self.string_ids.get(s)
+        if string_id is None:
+            string_id = self.string_ids[s] = len(self.strings)
+            self.strings.append(s)
+        return string_id
+
+    def string(self, string_id):
+        return None if string_id == NO_STRING else self.strings[string_id]
+
+    def append(self, item, client=None):
+        """ Add a TimesheetLineItem (or row view) as a new row. """
+        self.dates.append(item.date.toordinal())
+        self.billcodes.append(self.intern(item.billcode))
+        self.hours.append(float('nan') if item.hours is None else item.hours)
+        self.prefixes.append(self.intern(item.prefix))
+        self.suffixes.append(self.intern(item.suffix))
+        self.clients.append(self.intern(client))
+
+        if item.ranges is None:
+            self.range_offsets.append(NO_RANGES)
+            self.range_counts.append(0)
+            return
+        self.range_offsets.append(len(self.range_starts))
+        self.range_counts.append(len(item.ranges))
+        for r in item.ranges:
+            if 's' not in r:
+                self.range_starts.append(RANGE_HOURS_ONLY)
+                self.range_ends.append(TIME_MISSING)
+            else:
+                self.range_starts.append(to_minutes(r['s']))
+                self.range_ends.append(to_minutes(r['e']))
+            self.range_hours.append(float('nan') if r['duration'] is None else r['duration'])
+
+    def extend(self, items, client=None):
+        for item in items:
+            self.append(item, client)
+
+    def add_boundary(self, kind, line):
+        """ Note a summary or invoice marker line after the current last row. """
+        comment = line.split('#', 1)[1].strip() if '#' in line else ''
+        self.boundary_rows.append(len(self))
+        self.boundary_kinds.append(kind)
+        self.boundary_labels.append(self.intern(comment))
+
+    def boundaries(self):
+        """ (row, kind, label) of each marker, where row is the number of entries before it. """
+        return [(row, kind, self.string(label)) for row, kind, label in
+            zip(self.boundary_rows, self.boundary_kinds, self.boundary_labels)]
+
+    def ranges(self, i):
+        """ Row i's ranges, as the list of dicts parse() produces (or None). """
+        offset = self.range_offsets[i]
+        if offset == NO_RANGES:
+            return None
+        day = date.fromordinal(self.dates[i])
+        ranges = []
+        for j in range(offset, offset + self.range_counts[i]):
+            duration = nan_to_none(self.range_hours[j])
+            if self.range_starts[j] == RANGE_HOURS_ONLY:
+                ranges.append({'duration': duration})
+            else:
+                ranges.append({'s': from_minutes(day, self.range_starts[j]), 'e': from_minutes(day, self.range_ends[j]),
+                    'duration': duration})
+        return ranges
+
+    @property
+    def nbytes(self):
+        """ Size of the arrays, not counting the interned strings. """
+        return sum(len(a) * a.itemsize for a in self.columns().values())
+
+    def columns(self):
+        return {name: getattr(self, name) for name in ENTRY_STORE_COLUMNS}
+
+    def __len__(self):
+        return len(self.dates)
+
+    def __getitem__(self, i):
+        if not -len(self) <= i < len(self):
+            raise IndexError(i)
+        return EntryView(self, i % len(self))
+
+    def __iter__(self):
+        return (EntryView(self, i) for i in range(len(self)))
+
+
+ENTRY_STORE_COLUMNS = ('dates', 'billcodes', 'hours', 'prefixes', 'suffixes', 'clients', 'range_offsets',
+    'range_counts', 'range_starts', 'range_ends', 'range_hours', 'boundary_rows', 'boundary_kinds', 'boundary_labels')
+
+
+class EntryView:
+    """ A row of an EntryStore, read through the TimesheetLineItem attributes. """
+    __slots__ = ('store', 'index')
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    @property
+    def date(self):
+        return date.fromordinal(self.store.dates[self.index])
+
+    @property
+    def billcode(self):
+        return self.store.string(self.store.billcodes[self.index])
+
+    @property
+    def hours(self):
+        return nan_to_none(self.store.hours[self.index])
+
+    @property
+    def prefix(self):
+        return self.store.string(self.store.prefixes[self.index])
+
+    @property
+    def suffix(self):
+        return self.store.string(self.store.suffixes[self.index])
 
-            # print 'skipped...'
+    @property
+    def client(self):
+        return self.store.string(self.store.clients[self.index])
+
+    @property
+    def ranges(self):
+        return self.store.ranges(self.index)
+
+    def to_item(self):
+        return TimesheetLineItem(date=self.date, prefix=self.prefix, suffix=self.suffix, billcode=self.billcode,
+            hours=self.hours, ranges=self.ranges)
+
+    def __repr__(self):
+        return 'EntryView({!r}, {})'.format(self.to_item(), self.index)
+
+
+def load_entries(f, parser=None, store=None):
+    """ Parse every entry of the timesheet f into an EntryStore (new, or the
+    one given), returning (settings, store).  Rows are tagged with the
+    timesheet's client_name, and summary and invoice markers (once entries
+    have started) are kept as boundaries.
+    """
+    settings, _ = load_front_matter(f)
+    if parser is not None:
+        settings['parser'] = parser
+    if store is None:
+        store = EntryStore()
+    client = settings.get('client_name')
+    for kind, line, ret in parse_lines(classify_lines(f, settings), settings):
+        if kind == ENTRY:
+            store.append(ret, client)
+        elif kind == SUMMARY_MARKER:
+            store.add_boundary(BOUNDARY_SUMMARY, line)
+        elif kind == INVOICE_MARKER:
+            store.add_boundary(BOUNDARY_INVOICE, line)
+    return settings, store
+
+
+# Binary snapshot.  '.x.txt.tssnap' holds the EntryStore (and settings) of
+# x.txt in a fixed layout, so readers can mmap it and use its columns in
+# place instead of parsing the text.  It's rebuilt whenever x.txt, or any of
+# CONFIG_FILES its settings were merged from, changes.
+#
+#   header:   SNAPSHOT_HEADER, then an (offset, length) SNAPSHOT_SECTION for each of
+#   sections: ENTRY_STORE_COLUMNS (native-endian, 8-byte aligned),
+#             then the interned strings and the settings, as JSON
+SNAPSHOT_MAGIC = b'TSSNAP\r\n'
+SNAPSHOT_VERSION = 2
+SNAPSHOT_HEADER = struct.Struct('<8sI6sQq16s16s')  # magic, version, byteorder, source size, mtime_ns, digest, config
+SNAPSHOT_SECTION = struct.Struct('<QQ')
+SNAPSHOT_SECTIONS = ENTRY_STORE_COLUMNS + ('strings', 'settings')
+
+def snapshot_filename(filename):
+    """ The snapshot of 'dir/x.txt' lives in 'dir/.x.txt.tssnap'. """
+    head, tail = os.path.split(filename)
+    return os.path.join(head, '.{}.tssnap'.format(tail))
+
+def source_digest(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+def config_digest():
+    """ A digest of config_key(), which changes whenever a config file does. """
+    return hashlib.blake2b(json.dumps(config_key()).encode('utf-8'), digest_size=16).digest()
+
+def write_snapshot(filename, store, settings, source_stat, digest, config):
+    """ Write store and settings, as parsed from a source with the given
+    os.stat() and digest, with config files as of config_digest() config.
+    """
+    columns = store.columns()
+    blobs = [columns[name].tobytes() for name in ENTRY_STORE_COLUMNS]
+    blobs.append(json.dumps(store.strings).encode('utf-8'))
+    blobs.append(json.dumps(settings, default=str).encode('utf-8'))
+
+    header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, sys.byteorder.encode('ascii'),
+        source_stat.st_size, source_stat.st_mtime_ns, digest, config)
+    offset = len(header) + SNAPSHOT_SECTION.size * len(blobs)
+    table, body = [], []
+    for blob in blobs:
+        padding = -offset % 8
+        body.append(b'\0' * padding)
+        offset += padding
+        table.append(SNAPSHOT_SECTION.pack(offset, len(blob)))
+        body.append(blob)
+        offset += len(blob)
+
+    temp_filename = filename + '.temp'
+    with open(temp_filename, 'wb') as f:
+        f.write(header)
+        f.writelines(table)
+        f.writelines(body)
+    os.replace(temp_filename, filename)
+
+def read_snapshot(filename, source_filename):
+    """ Map the snapshot, returning (settings, store), or None if it's missing,
+    from another version or machine, or out of date with source_filename or
+    the config files.
+
+    The store's columns are read-only memoryviews of the mapped file.
+    """
+    import mmap
+    try:
+        with open(filename, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+
+    view = memoryview(mapped)
+    table_end = SNAPSHOT_HEADER.size + SNAPSHOT_SECTION.size * len(SNAPSHOT_SECTIONS)
+    if len(view) < table_end:
+        return None
+    magic, version, byteorder, size, mtime_ns, digest, config = SNAPSHOT_HEADER.unpack_from(view)
+    if (magic, version, byteorder.rstrip(b'\0')) != (SNAPSHOT_MAGIC, SNAPSHOT_VERSION, sys.byteorder.encode('ascii')):
+        return None
+    if config != config_digest():
+        return None
+    try:
+        st = os.stat(source_filename)
+        if (st.st_size, st.st_mtime_ns) != (size, mtime_ns):
+            with open(source_filename, 'rb') as f:
+                if source_digest(f.read()) != digest:
+                    return None
+    except OSError:
+        return None
+
+    sections = {}
+    for i, name in enumerate(SNAPSHOT_SECTIONS):
+        offset, length = SNAPSHOT_SECTION.unpack_from(view, SNAPSHOT_HEADER.size + i * SNAPSHOT_SECTION.size)
+        sections[name] = view[offset:offset + length]
+
+    store = EntryStore()
+    for name, column in store.columns().items():
+        setattr(store, name, sections[name].cast(column.typecode))
+    store.strings = json.loads(bytes(sections['strings']))
+    store.string_ids = {s: i for i, s in enumerate(store.strings)}
+    store.mapped = mapped
+    return json.loads(bytes(sections['settings'])), store
+
+def load_snapshot(filename, parser=None):
+    """ (settings, store) of the timesheet filename, from its snapshot if that's
+    up to date, or else parsed and written to a new snapshot.
+
+    >>> import tempfile
+    >>> filename = os.path.join(tempfile.mkdtemp(), 'x.txt')
+    >>> with open(filename, 'w') as f:
+    ...     _ = f.write('client_name: X\\n----\\n2015-07-13 IMPL 2\\n---- # week 1\\n2015-07-20 3\\n==== # INV1, first\\n')
+    >>> with redirect_stdout(io.StringIO()):
+    ...     settings, store = load_snapshot(filename)
+    >>> settings['client_name'], len(store), store.boundaries(), type(store.dates).__name__
+    ('X', 2, [(1, 1, 'week 1'), (2, 2, 'INV1, first')], 'array')
+    >>> settings, store = load_snapshot(filename)
+    >>> settings['client_name'], len(store), store.boundaries(), type(store.dates).__name__
+    ('X', 2, [(1, 1, 'week 1'), (2, 2, 'INV1, first')], 'memoryview')
+    >>> format_ret(store[1])
+    '2015-07-20          3'
+    >>> shutil.rmtree(os.path.dirname(filename))
+    """
+    snapshot = snapshot_filename(filename)
+    if parser is None:
+        result = read_snapshot(snapshot, filename)
+        if result is not None:
+            return result
+
+    st = os.stat(filename)
+    config = config_digest()
+    with open(filename, 'rb') as f:
+        data = f.read()
+    settings, store = load_entries(io.StringIO(data.decode('utf-8')), parser=parser)
+    if parser is None:
+        write_snapshot(snapshot, store, settings, st, source_digest(data), config)
+    return settings, store
+
+
+# Sidecar parse cache.
+CACHE_VERSION = 2
+CACHE_CHECKPOINT_LIMIT = 16  # the latest checkpoints, all kept
+CACHE_SPARSE_CHECKPOINTS = 48  # and some of the earlier ones, spread over the rest of the file
+
+def sidecar_cache_filename(filename):
+    """ The parse cache for 'dir/x.txt' lives in 'dir/.x.txt.tscache'. """
+    head, tail = os.path.split(filename)
+    return os.path.join(head, '.{}.tscache'.format(tail))
+
+def settings_fingerprint(settings):
+    fingerprinted = {k: v for k, v in settings.items() if k != 'verbose'}
+    text = json.dumps([CACHE_VERSION, fingerprinted], sort_keys=True, default=str)
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+def thin_checkpoints(checkpoints, limit=CACHE_CHECKPOINT_LIMIT, sparse=CACHE_SPARSE_CHECKPOINTS):
+    """ The last limit checkpoints, and up to sparse of the ones before, evenly spread.
+
+    >>> [c['line'] for c in thin_checkpoints([{'line': n} for n in range(1, 101)], 4, 3)]
+    [32, 64, 96, 97, 98, 99, 100]
+    """
+    older, latest = checkpoints[:-limit], checkpoints[-limit:]
+    if len(older) > sparse:
+        step = len(older) / sparse
+        older = [older[round((k + 1) * step) - 1] for k in range(sparse)]
+    return older + latest
+
+def line_key(line):
+    return hashlib.blake2b(line.encode('utf-8'), digest_size=12).hexdigest()
+
+def encode_item(ret):
+    ranges = None
+    if ret.ranges is not None:
+        ranges = []
+        for r in ret.ranges:
+            if 's' not in r:
+                ranges.append([r['duration']])
+            else:
+                s = r['s'].isoformat() if r['s'] is not None else None
+                e = r['e'].isoformat() if r['e'] is not None else None
+                ranges.append([s, e, r['duration']])
+    return [ret.date.isoformat(), ret.prefix, ret.suffix, ret.billcode, ret.hours, ranges]
+
+def decode_item(data):
+    date_s, prefix, suffix, billcode, hours, ranges = data
+    ret = TimesheetLineItem(date=date.fromisoformat(date_s), prefix=prefix, suffix=suffix,
+        billcode=billcode, hours=hours)
+    if ranges is not None:
+        ret.ranges = []
+        for r in ranges:
+            if len(r) == 1:
+                ret.ranges.append({'duration': r[0]})
+            else:
+                s = datetime.fromisoformat(r[0]) if r[0] is not None else None
+                e = datetime.fromisoformat(r[1]) if r[1] is not None else None
+                ret.ranges.append({'s': s, 'e': e, 'duration': r[2]})
+    return ret
+
+class ParseCache:
+    """ Sidecar cache of one timesheet's parsed lines and running totals.
+
+    Every entry line's parsed TimesheetLineItem and canonical output are kept,
+    keyed by a hash of the line.  At the first entry of each week the running
+    totals are checkpointed, keyed by a hash of all body text up to there, but
+    only when the output so far is identical to the input.  The next run can
+    then copy everything up to the last matching checkpoint straight through,
+    and only parse what follows it.  The latest checkpoints are all saved,
+    and a sparse few of the rest (see thin_checkpoints()), so that there is
+    one not far before any line (for format_region()).
+
+    The whole cache is discarded when the settings (front matter,
+    ~/.tsconfig.yml, default.yml) or CACHE_VERSION change.  The checkpoints
+    are on the file's first line, and the (much longer) lines on its second,
+    so that lines=False can skip them.
+    """
+    def __init__(self, filename, settings, parse_line=parse, lines=True):
+        self.filename = filename
+        self.parse_line = parse_line
+        self.fingerprint = settings_fingerprint(settings)
+        self.lines = {}
+        self.invoices = []
+        self.checkpoints = []
+        self.load(lines)
+
+        # What this run saw, which is all that gets saved.
+        self.used_lines = {}
+        self.line_count = 0
+        self.in_hash = hashlib.blake2b()
+        self.out_hash = hashlib.blake2b()
+
+    def load(self, lines=True):
+        try:
+            with open(self.filename) as f:
+                data = json.loads(f.readline())
+                if data['version'] != CACHE_VERSION or data['fingerprint'] != self.fingerprint:
+                    return
+                if lines:
+                    self.lines = json.loads(f.readline())
+            self.invoices = data['invoices']
+            self.checkpoints = data['checkpoints']
+        except (IOError, ValueError, KeyError, TypeError):
             pass
-            # logger.exception("failed to parse")
-            # raise
-    write_summary_line()
-    if outf:
-        outf.close()
-
-    print("{} hours uninvoiced currently...".format(format_hours(invoice_hours)))
-
-    if args.invoice:
-        for i in invoices:
-            invoice = Invoice(i['id'], [], settings['client_name'], footer=settings['footer'], body=[i['description']], address=settings['address'])
-            for item in i['items']:
-                if settings['billcode']:
-                    billcode_data = settings['billcodes'][item.billcode]
-                else:
-                    billcode_data = settings['billcodes']['default']
-                    
-                invoice.add_item(
-                    name=billcode_data['description'],
-                    qty=round(item.hours, 2),
-                    unit_price=billcode_data['rate'],
-                    description=billcode_data['description'])
 
-            invoice_filename_template = settings['invoice_filename_template']
-            invoice_filename = invoice_filename_template.format(
-                invoice_code=i['id'],
-                client_name=settings['client_name']
-            )
+    def save(self, totals):
+        data = {
+            'version': CACHE_VERSION,
+            'fingerprint': self.fingerprint,
+            'invoices': totals.invoices,
+            'checkpoints': thin_checkpoints(self.checkpoints),
+        }
+        temp_filename = self.filename + '.temp'
+        with open(temp_filename, 'w') as f:
+            f.write(json.dumps(data, separators=(',', ':'), default=str) + '\n')
+            f.write(json.dumps(self.used_lines, separators=(',', ':'), default=str) + '\n')
+        os.replace(temp_filename, self.filename)
+
+    def snapshot(self, totals, digest):
+        return {
+            'line': self.line_count,
+            'digest': digest,
+            'weekly_hours': totals.weekly_hours,
+            'invoice_hours': totals.invoice_hours,
+            'invoice_hours_per_code': dict(totals.invoice_hours_per_code),
+            'invoices': len(totals.invoices),
+            'last_date': totals.last_date.isoformat(),
+            'last_week': list(totals.last_week),
+            'seen_dates': [totals.seen_dates.base, totals.seen_dates.bits.hex()],
+        }
+
+    def restore(self, checkpoint, totals):
+        totals.weekly_hours = checkpoint['weekly_hours']
+        totals.invoice_hours = checkpoint['invoice_hours']
+        totals.invoice_hours_per_code = defaultdict(int, checkpoint['invoice_hours_per_code'])
+        totals.invoices = self.invoices[:checkpoint['invoices']]
+        totals.started = True
+        totals.last_date = date.fromisoformat(checkpoint['last_date'])
+        totals.last_week = tuple(checkpoint['last_week'])
+        totals.seen_dates.base, bits = checkpoint['seen_dates']
+        totals.seen_dates.bits = bytearray.fromhex(bits)
+
+    def replay(self, lines, totals, outf):
+        """ Copy body lines straight to outf up to the last checkpoint that
+        still matches, restoring totals from it.  Returns the remaining lines.
+        """
+        lines = iter(lines)
+        checkpoints, self.checkpoints = self.checkpoints, []
+        pending = []
+        probe = self.in_hash.copy()
+        for checkpoint in checkpoints:
+            for line in lines:
+                pending.append(line)
+                probe.update(line.encode('utf-8'))
+                if self.line_count + len(pending) == checkpoint['line']:
+                    break
+            if self.line_count + len(pending) != checkpoint['line'] or probe.hexdigest() != checkpoint['digest']:
+                break
+
+            for line in pending:
+                key = line_key(line.rstrip())
+                if key in self.lines:
+                    self.used_lines[key] = self.lines[key]
+                if outf:
+                    outf.write(line)
+            self.line_count += len(pending)
+            self.in_hash = probe.copy()
+            self.out_hash = probe.copy()
+            pending = []
+            self.restore(checkpoint, totals)
+            self.checkpoints.append(checkpoint)
+
+        return chain(pending, lines)
+
+    def resume(self, lines, totals):
+        """ Restore totals from the last checkpoint that still matches the
+        list of body lines, for a run that won't save the cache.  Returns how
+        many lines it covers.
+        """
+        for checkpoint in reversed(self.checkpoints):
+            if checkpoint['line'] <= len(lines):
+                digest = hashlib.blake2b(''.join(lines[:checkpoint['line']]).encode('utf-8')).hexdigest()
+                if digest == checkpoint['digest']:
+                    self.restore(checkpoint, totals)
+                    return checkpoint['line']
+        return 0
+
+    def read(self, lines):
+        """ Source stage: hash the body lines as they are read. """
+        for line in lines:
+            self.line_count += 1
+            self.in_hash.update(line.encode('utf-8'))
+            yield line
+
+    def write(self, chunks):
+        """ Hash the output as it is written. """
+        for chunk in chunks:
+            self.out_hash.update(chunk.encode('utf-8'))
+            yield chunk
+
+    def checkpoint(self, records, totals):
+        """ Pass records through, checkpointing after the first entry of each week. """
+        after_summary = False
+        for record in records:
+            yield record
+            if record[0] == SUMMARY:
+                after_summary = True
+            elif record[0] == ENTRY and after_summary:
+                after_summary = False
+                digest = self.in_hash.hexdigest()
+                if digest == self.out_hash.hexdigest():
+                    self.checkpoints.append(self.snapshot(totals, digest))
+
+    def parse(self, line, settings):
+        key = line_key(line.rstrip())
+        cached = self.lines.get(key)
+        if cached is not None:
+            self.used_lines[key] = cached
+            return decode_item(cached[1])
+
+        ret = self.parse_line(line, settings)
+        if ret is not None:
+            self.used_lines[key] = [None, encode_item(ret)]
+        return ret
+
+    def format_ret(self, ret, settings, line):
+        cached = self.used_lines[line_key(line.rstrip())]
+        if cached[0] is None:
+            cached[0] = format_ret(ret, settings)
+        return cached[0]
+
+
+# --profile hands a Profile to the run (TimesheetProcessor(profile=...)),
+# which then calls timed stand-ins for its stage functions, passed down
+# like any other argument; an unprofiled run calls the plain functions, so
+# costs nothing extra.  Nothing module-wide changes, so other runs going on
+# at the same time are neither timed nor disturbed.  Stages nest: 'parse'
+# includes 'scan' and 'dates/times', and 'total' includes everything.
+PROFILE_STAGE_ORDER = ('settings', 'parse', 'scan', 'dates/times', 'format', 'write', 'invoice', 'total')
+PROFILE_COUNTERS = ('parsed', 'passed_through', 'blank', 'summary_marker', 'invoice_marker', 'warnings')
+
+
+class Profile:
+    """ Wall and CPU time per stage, and counts of lines by outcome, for one run. """
+    def __init__(self):
+        self.stages = {name: [0, 0., 0.] for name in PROFILE_STAGE_ORDER}
+        self.counters = dict.fromkeys(PROFILE_COUNTERS, 0)
+        self.active = set()
+
+    def timed(self, name, fn):
+        """ Wrap fn to add its calls and time to stage name. """
+        stage = self.stages.setdefault(name, [0, 0., 0.])
+        perf_counter, process_time = time.perf_counter, time.process_time
+
+        def timed_fn(*args, **kwargs):
+            wall, cpu = perf_counter(), process_time()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                stage[0] += 1
+                stage[1] += perf_counter() - wall
+                stage[2] += process_time() - cpu
+        return timed_fn
+
+    @contextmanager
+    def stage(self, name):
+        """ Time the block as stage name; a stage within itself only counts once. """
+        if name in self.active:
+            yield
+            return
+        self.active.add(name)
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            stage = self.stages.setdefault(name, [0, 0., 0.])
+            stage[0] += 1
+            stage[1] += time.perf_counter() - wall
+            stage[2] += time.process_time() - cpu
+            self.active.discard(name)
+
+    def parse(self):
+        """ parse(), timed as 'parse', with its scanners and date and time parsing timed too. """
+        scanners = {key: self.timed('scan', scan) for key, scan in LINE_SCANNERS.items()}
+        timed_parse_date = self.timed('dates/times', parse_date)
+        timed_parse_time = self.timed('dates/times', parse_time)
+        return self.timed('parse', lambda line, settings: parse(line, settings, scanners=scanners,
+            parse_date=timed_parse_date, parse_time=timed_parse_time))
+
+    def count_lines(self, parsed):
+        """ Pass-through stage after parse_lines(), counting lines by outcome. """
+        counters = self.counters
+        for record in parsed:
+            kind, line = record[0], record[1]
+            if kind == ENTRY:
+                counters['parsed'] += 1
+            elif kind == TEXT:
+                counters['blank' if line.strip() == '' else 'passed_through'] += 1
+            else:
+                counters[kind] += 1
+            yield record
+
+    def as_dict(self):
+        return {
+            'stages': {name: {'calls': calls, 'wall': wall, 'cpu': cpu} for name, (calls, wall, cpu) in self.stages.items()},
+            'counters': dict(self.counters),
+        }
+
+    def format_table(self):
+        """
+        >>> p = Profile()
+        >>> p.stages['parse'] = [3, .5, .25]
+        >>> p.counters['parsed'] = 3
+        >>> print(p.format_table())
+        stage            calls     wall s      cpu s
+        parse                3      0.500      0.250
+        <BLANKLINE>
+        parsed 3, passed_through 0, blank 0, summary_marker 0, invoice_marker 0, warnings 0
+        """
+        rows = ['{:<12} {:>9} {:>10} {:>10}'.format('stage', 'calls', 'wall s', 'cpu s')]
+        for name, (calls, wall, cpu) in self.stages.items():
+            if calls:
+                rows.append('{:<12} {:>9} {:>10.3f} {:>10.3f}'.format(name, calls, wall, cpu))
+        rows.append('')
+        rows.append(', '.join('{} {}'.format(name, count) for name, count in self.counters.items()))
+        return '\n'.join(rows)
+
+
+def process_timesheet(f, outf, verbose=None, invoice=False, cache_filename=None, parser=None, parse_jobs=None,
+        invoice_jobs=None, force_invoices=False, profile=None):
+    processor = TimesheetProcessor(verbose=verbose, invoice=invoice, parser=parser, parse_jobs=parse_jobs,
+        invoice_jobs=invoice_jobs, force_invoices=force_invoices, log=print, profile=profile)
+    try:
+        result = processor.process(f, outf, cache_filename)
+    except FrontMatterError as exc:
+        print(exc)
+        sys.exit(1)
+    return result.settings, result.totals
 
-            invoice.save(invoice_filename)
-            print("Wrote invoice to {}".format(invoice_filename))
 
+@dataclass
+class FileResult:
+    filename: str
+    success: bool = False
+    changed: bool = False
+    client_name: Optional[str] = None
+    uninvoiced_hours: float = 0.
+    output: str = ''
 
-if __name__=='__main__':
-    import argparse
 
-    parser = argparse.ArgumentParser(description='Process a timesheet')
-    parser.add_argument('file', metavar='FILE')
-    parser.add_argument('-v', '--verbose', action='count', default=None)
-    parser.add_argument('-i', '--invoice', action='store_true', help='Write PDF invoice.')
-    parser.add_argument('-o', '--out', default=None, help="Defaults to overwrite -f FILE.")
+class OutputBuffer(io.StringIO):
+    """ A StringIO whose text outlives the close() at the end of process_timesheet(). """
+    text = ''
 
-    args = parser.parse_args()
+    def close(self):
+        self.text = self.getvalue()
+        super().close()
 
-    if args.out is None:
-        args.out = args.file
 
-    input_filename = args.file
-    output_filename = args.out
-    is_inplace = samefile(input_filename, output_filename)
+# Timesheets are only rewritten when their canonical form differs, from a
+# temp file renamed over them, so an unchanged file keeps its mtime and a
+# crash never leaves it half-written.  The version being replaced is kept
+# as FILE.backup, the one before as FILE.backup.1, and so on.
+BACKUPS = 1
+BACKUP_REGEX = re.compile(r'\.backup(?:\.[0-9]+)?$')
 
-    backup_input_filename = input_filename + '.backup'
-    shutil.copyfile(input_filename, backup_input_filename)
+def backup_filenames(filename, count):
+    """
+    >>> backup_filenames('x.txt', 3)
+    ['x.txt.backup', 'x.txt.backup.1', 'x.txt.backup.2']
+    """
+    return [filename + '.backup'] + ['{}.backup.{}'.format(filename, i) for i in range(1, count)]
 
-    if not is_inplace:
-        backup_output_filename = output_filename + '.backup'
-        shutil.copyfile(output_filename, backup_output_filename)
+def rotate_backups(filename, count=BACKUPS):
+    """ Shift filename's backups along one, dropping the oldest, and make
+    filename (as it is now) the newest.
+    """
+    if count <= 0:
+        return
+    names = backup_filenames(filename, count)
+    for i in range(count - 1, 0, -1):
+        if os.path.exists(names[i - 1]):
+            os.replace(names[i - 1], names[i])
+    if os.path.exists(names[0]):
+        os.unlink(names[0])
+    try:
+        # The rename in write_if_changed() leaves this link holding the old contents, without a copy.
+        os.link(filename, names[0])
+    except OSError:
+        shutil.copy2(filename, names[0])
+
+def replace_contents(filename, chunks, mode='w', backups=BACKUPS):
+    """ Atomically replace filename's contents with chunks (of str, or of
+    bytes with mode='wb'), keeping backups of what was there.  A symlink is
+    written through: the file it points to is replaced, and backed up.
+    """
+    filename = os.path.realpath(filename)
+    try:
+        st = os.stat(filename)
+    except FileNotFoundError:
+        st = None
+
+    head, tail = os.path.split(filename)
+    temp_filename = os.path.join(head, '.{}.{}.{}.temp'.format(tail, os.getpid(), threading.get_ident()))
+    try:
+        with open(temp_filename, mode) as f:
+            for chunk in chunks:
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        if st is not None:
+            os.chmod(temp_filename, st.st_mode & 0o7777)
+            rotate_backups(filename, backups)
+        os.replace(temp_filename, filename)
+    except BaseException:
+        if os.path.exists(temp_filename):
+            os.unlink(temp_filename)
+        raise
+
+def write_if_changed(filename, text, backups=BACKUPS):
+    """ Atomically replace filename's contents with text, unless they're the
+    same already.  Returns whether it was written.
+    """
+    try:
+        with open(filename) as f:
+            if f.read() == text:
+                return False
+    except FileNotFoundError:
+        pass
+    replace_contents(filename, [text], backups=backups)
+    return True
+
+
+# The warnings of the run in progress in this thread (or context), if any.
+# One handler stays installed for good, as adding and removing handlers
+# while other threads log can make them skip theirs.
+RUN_WARNINGS = contextvars.ContextVar('run_warnings', default=None)
 
-    copy_to_on_completion = None
+class RunWarnings(logging.Handler):
+    """ Adds each warning logged to the RUN_WARNINGS list of the run that logged it. """
+    def __init__(self):
+        super().__init__(logging.WARNING)
 
-    if is_inplace:
-        real_output_filename = output_filename
-        output_filename = output_filename + '.temp_outfile'
+    def emit(self, record):
+        messages = RUN_WARNINGS.get()
+        if messages is not None:
+            messages.append(record.getMessage())
 
-    with open(input_filename) as f, open(output_filename, 'w') as outf:
+logger.addHandler(RunWarnings())
+
+
+@dataclass
+class TimesheetResult:
+    settings: dict
+    totals: RunningTotals
+    hours_this_week: float = 0.
+    warnings: List[str] = field(default_factory=list)
+    messages: List[str] = field(default_factory=list)
+    changed: Optional[bool] = None  # by TimesheetProcessor.process_file()
+
+    @property
+    def hours_uninvoiced(self):
+        return self.totals.invoice_hours
+
+    @property
+    def invoices(self):
+        return self.totals.invoices
+
+
+class TimesheetProcessor:
+    """ Processes timesheets, as a library.
+
+    Everything a run touches (settings, totals, caches, warnings, output)
+    belongs to that run: messages are collected in the result (and passed to
+    log, if given) rather than printed, warnings logged while it runs are
+    collected too, and bad input raises (e.g. FrontMatterError) rather than
+    exiting.  So runs can go on in parallel threads or processes, with one
+    processor or many, as long as no two write the same file at once.
+
+    With a Profile, runs are serial (parse_jobs and invoice_jobs are 1), so
+    that every stage is timed in this process.
+
+    >>> processor = TimesheetProcessor()
+    >>> out = OutputBuffer()
+    >>> result = processor.process(io.StringIO('client_name: ACME\\n----\\n2015-06-01 IMPL 2\\n2015-06-01 ARCH 1\\n'), out)
+    >>> print(out.text.strip())
+    client_name: ACME
+    ----
+    2015-06-01 IMPL     2
+    2015-06-01 ARCH     1
+    ----------       3 (3 uninvoiced)
+    >>> result.hours_this_week, result.hours_uninvoiced, result.warnings
+    (3.0, 3.0, ['Date 2015-06-01 listed multiple times.'])
+    """
+    def __init__(self, verbose=None, invoice=False, parser=None, use_cache=True, parse_jobs=1, invoice_jobs=1,
+            force_invoices=False, backups=BACKUPS, log=None, profile=None):
+        self.verbose = verbose
+        self.invoice = invoice
+        self.parser = parser
+        self.use_cache = use_cache
+        self.parse_jobs = parse_jobs
+        self.invoice_jobs = invoice_jobs
+        self.force_invoices = force_invoices
+        self.backups = backups
+        self.log = log
+        self.profile = profile
+        if profile is not None:
+            self.parse_jobs = self.invoice_jobs = 1
+
+    def stage(self, name):
+        """ A context manager timing a block as stage name of the profile, if any. """
+        return self.profile.stage(name) if self.profile is not None else ExitStack()
+
+    def process(self, f, outf=None, cache_filename=None):
+        """ Process the timesheet f, writing its canonical form to outf (and
+        closing it), if given.  Returns a TimesheetResult.
+        """
+        messages = []
+
+        def log(message):
+            messages.append(message)
+            if self.log is not None:
+                self.log(message)
+
+        warnings = []
+        token = RUN_WARNINGS.set(warnings)
         try:
-            process_timesheet(f=f, outf=outf, verbose=args.verbose, invoice=args.invoice)
-            success = True
-        except Exception as exc:
-            logger.exception("Crash while processing timesheet.")
-            success = False
+            with self.stage('total'):
+                result = self.run(f, outf, cache_filename, log)
+        finally:
+            RUN_WARNINGS.reset(token)
+            if self.profile is not None:
+                self.profile.counters['warnings'] += len(warnings)
+        result.warnings, result.messages = warnings, messages
+        return result
+
+    def run(self, f, outf, cache_filename, log):
+        profile = self.profile
+        with self.stage('settings'):
+            settings, raw_front_matter = read_front_matter(f, log)
+        if self.verbose is not None:
+            settings['verbose'] = self.verbose
+        if self.parser is not None:
+            settings['parser'] = self.parser
+
+        totals = RunningTotals()
+        result = TimesheetResult(settings=settings, totals=totals)
+        write_lines(format_front_matter(raw_front_matter), outf)
+
+        def body(lines):
+            yield from lines
+            # Before aggregate_entries() closes out the week.
+            result.hours_this_week = totals.weekly_hours
+
+        lines = iter(f)
+        parse_line = parse if profile is None else profile.parse()
+        count_lines = (lambda parsed: parsed) if profile is None else profile.count_lines
+        timed = (lambda name, fn: fn) if profile is None else profile.timed
+        cache = None
+        if cache_filename is not None:
+            cache = ParseCache(cache_filename, settings)
+            lines = cache.replay(lines, totals, outf)
+
+        with ExitStack() as stack:
+            if use_parallel_parse(f, settings, self.parse_jobs):
+                jobs = self.parse_jobs or os.cpu_count()
+                from concurrent.futures import ProcessPoolExecutor
+                executor = stack.enter_context(ProcessPoolExecutor(max_workers=jobs))
+                parallel = ParallelParser(executor, jobs)
+                lines = parallel.read(lines, settings)
+                parse_line = parallel.parse
+
+            if cache is None:
+                parsed = count_lines(parse_lines(classify_lines(body(lines), settings, log), settings,
+                    parse_line=parse_line, log=log))
+                records = aggregate_entries(parsed, settings, totals, log)
+                format_entry = None if profile is None else timed('format',
+                    lambda ret, settings, line: format_ret(ret, settings))
+                write_lines(format_records(records, settings, format_entry=format_entry, log=log), outf)
+            else:
+                cache.parse_line = parse_line
+                parsed = count_lines(parse_lines(classify_lines(body(cache.read(lines)), settings, log), settings,
+                    started=totals.started, parse_line=cache.parse, log=log))
+                records = cache.checkpoint(aggregate_entries(parsed, settings, totals, log), totals)
+                format_entry = timed('format', cache.format_ret)
+                write_lines(cache.write(format_records(records, settings, format_entry=format_entry, log=log)),
+                    outf)
+                cache.save(totals)
+
+        if outf:
+            outf.close()
+
+        log("{} hours uninvoiced currently...".format(format_hours(totals.invoice_hours)))
+
+        if self.invoice:
+            write_invoices(totals.invoices, settings, jobs=self.invoice_jobs, force=self.force_invoices, log=log,
+                render=timed('invoice', render_invoice))
+
+        return result
+
+    def process_file(self, input_filename, output_filename=None):
+        """ Process one timesheet file in place (or into output_filename),
+        only writing it if it changed.  Returns a TimesheetResult.
+        """
+        if output_filename is None:
+            output_filename = input_filename
+        outf = OutputBuffer()
+        cache_filename = sidecar_cache_filename(input_filename) if self.use_cache else None
+        with self.stage('total'):
+            with open(input_filename) as f:
+                result = self.process(f, outf, cache_filename)
+            with self.stage('write'):
+                result.changed = write_if_changed(output_filename, outf.text, backups=self.backups)
+        return result
+
+
+def process_file(input_filename, output_filename=None, verbose=None, invoice=False, parser=None, use_cache=True,
+        parse_jobs=None, invoice_jobs=None, force_invoices=False, profile=None, backups=BACKUPS):
+    """ Process one timesheet file in place (or into output_filename), only
+    writing it if it changed, keeping backups rotated and leaving the input
+    unharmed on failure.
+    """
+    if output_filename is None:
+        output_filename = input_filename
 
-    if success:
-        if is_inplace:
-            shutil.copyfile(output_filename, real_output_filename)
-            os.unlink(output_filename)
-        print("Success!")
+    result = FileResult(filename=input_filename)
+    processor = TimesheetProcessor(verbose=verbose, invoice=invoice, parser=parser, use_cache=use_cache,
+        parse_jobs=parse_jobs, invoice_jobs=invoice_jobs, force_invoices=force_invoices, backups=backups, log=print,
+        profile=profile)
+    try:
+        processed = processor.process_file(input_filename, output_filename)
+        result.client_name = processed.settings.get('client_name')
+        result.uninvoiced_hours = processed.hours_uninvoiced
+        result.changed = processed.changed
+        result.success = True
+    except FrontMatterError as exc:
+        print(exc)
+        sys.exit(1)
+    except Exception as exc:
+        logger.exception("Crash while processing timesheet.")
+
+    if result.success:
+        print("Success!" if result.changed else "Success! (unchanged, so not rewritten)")
     else:
         print("Crash while processing timesheet.  The input failed to process (but is unharmed).")
 
+    return result
+
+
+# Tail mode.  Everything up to and including the last invoice line that
+# ts.py has already written out (as opposed to a bare marker typed since) is
+# settled: those entries are invoiced, and every total is zero after it.  So
+# only what follows it is parsed and rewritten, and the history before it is
+# copied through byte for byte, however many years of it there are.  Edits
+# to the history are only picked up by a full run.
+TAIL_LAST_ENTRY_SEARCH_LINES = 100
+
+def invoice_line_regex(settings):
+    """ Matches an invoice line as ts.py writes it, whatever its hours.
+
+    >>> regex = invoice_line_regex(get_default_settings())
+    >>> bool(regex.match('==========       19.18 (26.68 since invoice) # INV1, January'))
+    True
+    >>> bool(regex.match('====  # INV1, January'))
+    False
+    """
+    import string
+    pattern = re.escape(settings['prefix'])
+    for literal, field, _, _ in string.Formatter().parse(settings['invoice_template']):
+        pattern += re.escape(literal)
+        if field is not None:
+            pattern += r'\S+'
+    return re.compile(pattern + r'(?: # .*)?$')
+
+
+def mapped_lines_after(mm, start=0):
+    """ Yield (offset, line) of each line of mm from start on. """
+    while start < len(mm):
+        end = mm.find(b'\n', start) + 1 or len(mm)
+        yield start, mm[start:end]
+        start = end
+
+
+def mapped_lines_before(mm, end, start=0):
+    """ Yield (offset, line) of each line of mm between start and end, last first. """
+    while end > start:
+        offset = mm.rfind(b'\n', start, end - 1) + 1 or start
+        yield offset, mm[offset:end]
+        end = offset
+
+
+def find_tail(mm, body_start, settings, encoding):
+    """ The offset just past the last invoice line ts.py wrote in mm, after
+    body_start, or None if there isn't one.
+    """
+    marker = settings['invoice_marker'].encode(encoding)
+    regex = invoice_line_regex(settings)
+    end = len(mm)
+    while True:
+        offset = mm.rfind(b'\n' + marker, body_start - 1, end) + 1
+        if offset <= 0:
+            return None
+        line_end = mm.find(b'\n', offset)
+        line_end = len(mm) if line_end < 0 else line_end + 1
+        if regex.match(mm[offset:line_end].decode(encoding).rstrip()):
+            return line_end
+        # A marker added since the last run: it's in the tail, so keep looking.
+        end = offset - 1
+
+
+def process_file_tail(filename, verbose=None, invoice=False, parser=None, invoice_jobs=None, force_invoices=False,
+        backups=BACKUPS):
+    """ Process only what follows the last written invoice line of the
+    timesheet filename, in place; or all of it, if there is no such line.
+    """
+    import mmap
+
+    def process_all():
+        return process_file(filename, verbose=verbose, invoice=invoice, parser=parser, invoice_jobs=invoice_jobs,
+            force_invoices=force_invoices, backups=backups)
+
+    result = FileResult(filename=filename)
+    with open(filename) as f:
+        encoding = f.encoding
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty, which process_file() will complain about
+            return process_all()
+
+        with mm:
+            body_start = None
+            for offset, line in mapped_lines_after(mm):
+                if FRONT_MATTER_TERMINUS_REGEX.match(line.decode(encoding).rstrip('\r\n')):
+                    body_start = offset + len(line)
+                    break
+            if body_start is None:
+                return process_all()
+
+            settings, _ = load_front_matter(io.StringIO(mm[:body_start].decode(encoding), newline=None))
+            if verbose is not None:
+                settings['verbose'] = verbose
+            if parser is not None:
+                settings['parser'] = parser
+            tail_start = find_tail(mm, body_start, settings, encoding) if settings['invoice_on'] == 'marker' else None
+            if tail_start is None:
+                print("No invoice line yet, so processing all of {}.".format(filename))
+                return process_all()
+
+            try:
+                totals = RunningTotals(started=True)
+                # The weeks of 'weekly' summaries carry on across the invoice line.
+                for _, line in islice(mapped_lines_before(mm, tail_start, body_start), TAIL_LAST_ENTRY_SEARCH_LINES):
+                    try:
+                        ret = parse(line.decode(encoding), settings)
+                    except (TimesheetSyntaxError, TimesheetParseError):
+                        continue
+                    if ret is not None:
+                        totals.last_date, totals.last_week = ret.date, ret.date.isocalendar()[:2]
+                        break
+
+                old_tail = mm[tail_start:].decode(encoding)
+                outf = io.StringIO()
+                # The blank line that follows every summary line.
+                outf.write('\n')
+                lines = io.StringIO(old_tail, newline=None)
+                parsed = parse_lines(classify_lines(lines, settings), settings, started=True)
+                write_lines(format_records(aggregate_entries(parsed, settings, totals), settings), outf)
+
+                new_tail = outf.getvalue()
+                if new_tail != old_tail:
+                    replace_contents(filename, [mm[:tail_start], new_tail.encode(encoding)], mode='wb', backups=backups)
+                    result.changed = True
+                print("{} hours uninvoiced currently...".format(format_hours(totals.invoice_hours)))
+                if invoice:
+                    write_invoices(totals.invoices, settings, jobs=invoice_jobs, force=force_invoices)
+                result.client_name = settings.get('client_name')
+                result.uninvoiced_hours = totals.invoice_hours
+                result.success = True
+            except Exception:
+                logger.exception("Crash while processing timesheet.")
+
+    if result.success:
+        print("Success!" if result.changed else "Success! (unchanged, so not rewritten)")
+    else:
+        print("Crash while processing timesheet.  The input failed to process (but is unharmed).")
+    return result
+
+
+
+# Filter mode, for editors: `ts.py -` reads a timesheet on stdin and writes
+# it canonicalized to stdout, touching no files.  With --lines, only that
+# region is reformatted and the rest copied through as is.  The totals its
+# summary lines need are restored from the last parse cache checkpoint
+# before it (see ParseCache, and --stdin-filename), so only the lines from
+# there on are parsed.
+def parse_line_range(value):
+    """ 'START:END' (1-based, inclusive; either may be left out) as (start, end).
+
+    >>> parse_line_range('10:12'), parse_line_range('7'), parse_line_range(':3'), parse_line_range('5:')
+    ((10, 12), (7, 7), (1, 3), (5, None))
+    """
+    start, sep, end = value.partition(':')
+    start = int(start) if start else 1
+    end = (int(end) if end else None) if sep else start
+    if start < 1 or (end is not None and end < start):
+        raise ValueError('bad line range {!r}'.format(value))
+    return start, end
+
+def format_region(text, start=1, end=None, verbose=None, parser=None, cache_filename=None, log=print):
+    """ text with lines start to end (as from parse_line_range()) canonicalized,
+    and every other line as it was.
+
+    >>> text = 'client_name: ACME\\n----\\n6/1/2015 IMPL 2\\n2015-06-02 ARCH 9a-10a\\n----\\n6/8/2015 IMPL 1\\n'
+    >>> print(format_region(text, 4, 5, log=lambda message: None), end='')
+    client_name: ACME
+    ----
+    6/1/2015 IMPL 2
+    2015-06-02 ARCH     1 9a-10a(1)
+    ----------       3 (3 uninvoiced)
+    <BLANKLINE>
+    6/8/2015 IMPL 1
+    """
+    lines = text.splitlines(keepends=True)
+    source = iter(lines)
+    settings, front_matter = read_front_matter(source, log)
+    if verbose is not None:
+        settings['verbose'] = verbose
+    if parser is not None:
+        settings['parser'] = parser
+
+    body_start = len(front_matter) + 1
+    body = lines[body_start:]
+    first = min(max(start - 1 - body_start, 0), len(body))
+    last = len(body) if end is None else min(max(end - body_start, 0), len(body))
+    if first >= last:
+        return text
+
+    def is_entry(line):
+        try:
+            return parse(line, settings) is not None
+        except (TimesheetSyntaxError, TimesheetParseError):
+            return False
+
+    if settings['summary_on'] != 'marker':
+        # A weekly summary line is dropped where it was and written again
+        # before the next week's first entry, so take in everything from the
+        # last entry before the region to the first one after it.
+        while first > 0 and not is_entry(body[first - 1]):
+            first -= 1
+        while last < len(body) and not is_entry(body[last - 1]):
+            last += 1
+    else:
+        # Blank lines belong to the summary line before them, so leave those the region starts with.
+        while first < last and body[first].strip() == '':
+            first += 1
+        if first >= last:
+            return text
+
+    totals = RunningTotals()
+    resumed = 0
+    if cache_filename is not None:
+        # Read only: the cache describes the file as saved, and this is a buffer.
+        cache = ParseCache(cache_filename, settings, lines=False)
+        resumed = cache.resume(body[:first], totals)
+    prefix = body[resumed:first]
+
+    state = {'region': False, 'done': False}
+
+    def read():
+        yield from prefix
+        state['region'] = True
+        yield from body[first:last]
+        state['done'] = True
+
+    parsed = parse_lines(classify_lines(read(), settings, log), settings, started=totals.started, log=log)
+    region = []
+    for chunk in format_records(aggregate_entries(parsed, settings, totals, log), settings, log=log):
+        # The pipeline doesn't read ahead, so each chunk comes of the line last read, bar the closing summary.
+        if state['region'] and (not state['done'] or last == len(body)):
+            region.append(chunk)
+
+    suffix = body[last:]
+    if region and region[-1] == '\n' and suffix and suffix[0].strip() == '':
+        # The blank line a summary line brings is already there.
+        region.pop()
+    return ''.join(lines[:body_start + first] + region + suffix)
+
+def filter_timesheet(infile, outfile, line_range=None, verbose=None, parser=None, cache_filename=None):
+    """ Canonicalize the timesheet infile (or only line_range of it) onto
+    outfile, with messages to stderr.  On failure, infile is written back as
+    it was, so an editor's buffer survives, and False returned.
+    """
+    log = lambda message: print(message, file=sys.stderr)
+    text = infile.read()
+    try:
+        if line_range is None:
+            out = OutputBuffer()
+            processor = TimesheetProcessor(verbose=verbose, parser=parser, log=log)
+            processor.process(io.StringIO(text), out)
+            formatted = out.text
+        else:
+            formatted = format_region(text, *line_range, verbose=verbose, parser=parser,
+                cache_filename=cache_filename, log=log)
+    except Exception as exc:
+        if isinstance(exc, FrontMatterError):
+            log(exc)
+        else:
+            logger.exception("Crash while processing timesheet.")
+        log("The input is passed through unchanged.")
+        outfile.write(text)
+        return False
+    outfile.write(formatted)
+    return True
+
+def process_file_for_batch(filename, options):
+    """ Run process_file() in a batch worker, capturing its output; no failure
+    (not even a missing front matter's sys.exit) escapes.
+    """
+    output = io.StringIO()
+    with redirect_stdout(output):
+        try:
+            result = process_file(filename, parse_jobs=1, invoice_jobs=1, **options)
+        except (Exception, SystemExit) as exc:
+            logger.exception("Crash while processing timesheet {}.".format(filename))
+            result = FileResult(filename=filename)
+    result.output = output.getvalue()
+    return result
+
+
+def process_batch(filenames, options, jobs=None):
+    """ Process many timesheets on a process pool, then summarize uninvoiced
+    hours per client.  Returns the FileResults, in the order given.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(process_file_for_batch, filename, options) for filename in filenames]
+        results = []
+        for filename, future in zip(filenames, futures):
+            try:
+                result = future.result()
+            except Exception:
+                logger.exception("Worker failed while processing timesheet {}.".format(filename))
+                result = FileResult(filename=filename)
+            print("== {}".format(filename))
+            sys.stdout.write(result.output)
+            results.append(result)
+
+    uninvoiced = defaultdict(float)
+    for result in results:
+        if result.success:
+            uninvoiced[result.client_name or result.filename] += result.uninvoiced_hours
+
+    print()
+    print("Uninvoiced hours by client:")
+    width = max([len(client) for client in uninvoiced] + [10])
+    for client in sorted(uninvoiced):
+        print("  {:<{}} {:>8}".format(client, width, format_hours(uninvoiced[client])))
+    print("  {:<{}} {:>8}".format('Total', width, format_hours(sum(uninvoiced.values()))))
+
+    failed = [result.filename for result in results if not result.success]
+    if failed:
+        print("{} of {} timesheets failed: {}".format(len(failed), len(results), ", ".join(failed)))
+
+    return results
+
+
+# Overlaps: the same clock time billed twice, by two ranges of one entry,
+# two entries of one timesheet, or two timesheets (i.e. clients).  All the
+# ranges are sorted by start and swept once, keeping the ones still open on
+# a heap ordered by end, so finding them takes O(n log n) (plus one step per
+# overlap found) however many years and contracts are checked together.
+@dataclass
+class TimedRange:
+    start: datetime
+    end: datetime
+    filename: str
+    lineno: int
+    line: str
+
+
+@dataclass
+class Overlap:
+    first: TimedRange
+    second: TimedRange
+
+    @property
+    def hours(self):
+        return (min(self.first.end, self.second.end) - self.second.start).total_seconds() / 3600.
+
+
+def timed_ranges(f, filename, parser=None):
+    """ Yield a TimedRange for every range with both a start and an end in
+    the timesheet f.  Lines that fail to parse are warned about and skipped.
+    """
+    settings, front_matter = load_front_matter(f)
+    if parser is not None:
+        settings['parser'] = parser
+    for lineno, line in enumerate(f, start=len(front_matter) + 2):
+        try:
+            ret = parse(line, settings)
+        except TimesheetSyntaxError:
+            continue
+        except TimesheetParseError as e:
+            logger.warning('{}:{}: {}'.format(filename, lineno, e))
+            continue
+        for r in (ret.ranges or ()) if ret is not None else ():
+            if r.get('s') is not None and r.get('e') is not None:
+                yield TimedRange(r['s'], r['e'], filename, lineno, line.rstrip())
+
+
+def find_overlaps(ranges):
+    """ Every pair of ranges that overlap (just touching doesn't count), in
+    order of where the overlap starts.
+
+    >>> def at(s, e, lineno):
+    ...     return TimedRange(datetime(2015, 6, 1, *s), datetime(2015, 6, 1, *e), 'x.txt', lineno, '')
+    >>> overlaps = find_overlaps([at((9,), (11,), 1), at((11,), (12,), 2), at((10,), (10, 30), 3), at((11, 30), (13,), 4)])
+    >>> [(o.first.lineno, o.second.lineno, o.hours) for o in overlaps]
+    [(1, 3, 0.5), (2, 4, 0.5)]
+    """
+    import heapq
+    overlaps = []
+    open_ranges = []  # heap of (end, n, range) of ranges started but not ended yet
+    for n, r in enumerate(sorted(ranges, key=lambda r: (r.start, r.end))):
+        while open_ranges and open_ranges[0][0] <= r.start:
+            heapq.heappop(open_ranges)
+        for _, _, other in sorted(open_ranges, key=lambda item: item[1]):
+            overlaps.append(Overlap(other, r))
+        heapq.heappush(open_ranges, (r.end, n, r))
+    return overlaps
+
+
+def format_overlap(overlap):
+    def where(r):
+        return '{}:{} {:%Y-%m-%d %H:%M}-{:%H:%M}'.format(r.filename, r.lineno, r.start, r.end)
+    return '{} overlaps {} by {} hours\n    {}\n    {}'.format(where(overlap.first), where(overlap.second),
+        format_hours(overlap.hours), overlap.first.line, overlap.second.line)
+
+
+# Export.  Entries and invoices are streamed out as they're parsed, one
+# record at a time, so exporting years of timesheets takes constant memory.
+EXPORT_CSV_COLUMNS = ('record', 'file', 'line', 'client', 'date', 'billcode', 'hours', 'start', 'end', 'comment',
+    'invoice')
+
+class LineCounter:
+    """ Pass lines through, keeping count of them. """
+    def __init__(self, lines, start=1):
+        self.lines = lines
+        self.lineno = start - 1
+
+    def __iter__(self):
+        for line in self.lines:
+            self.lineno += 1
+            yield line
+
+
+def entry_comment(suffix):
+    return suffix.split('#', 1)[1].strip() if '#' in suffix else ''
+
+
+def export_records(f, filename, parser=None):
+    """ Yield a dict for each entry of the timesheet f, and for each invoice
+    (after its entries), with the line it came from.
+    """
+    settings, front_matter = load_front_matter(f)
+    if parser is not None:
+        settings['parser'] = parser
+    yield from body_records(f, filename, settings, len(front_matter) + 2)
+
+
+def body_records(f, filename, settings, start=1):
+    """ export_records() of the rest of f, after the front matter, starting at line start. """
+    settings = dict(settings, verbose=0)
+    client = settings.get('client_name')
+    totals = RunningTotals()
+    lines = LineCounter(f, start=start)
+    parsed = parse_lines(classify_lines(lines, settings), settings)
+    for record in aggregate_entries(parsed, settings, totals):
+        if record[0] == ENTRY:
+            ret = record[1]
+            ranges = None
+            if ret.ranges is not None:
+                ranges = [{'start': r['s'].isoformat() if r.get('s') is not None else None,
+                    'end': r['e'].isoformat() if r.get('e') is not None else None,
+                    'hours': r['duration']} for r in ret.ranges]
+            yield {'record': 'entry', 'file': filename, 'line': lines.lineno, 'client': client,
+                'date': ret.date.isoformat(), 'billcode': ret.billcode, 'hours': ret.hours,
+                'comment': entry_comment(ret.suffix), 'ranges': ranges}
+        elif record[0] == SUMMARY and record[2] is not None:
+            invoice_data = record[2]
+            yield {'record': 'invoice', 'file': filename, 'line': lines.lineno, 'client': client,
+                'date': totals.last_date.isoformat() if totals.last_date is not None else None,
+                'invoice': invoice_data['id'], 'description': invoice_data['description'],
+                'hours': invoice_data['hours'], 'items': invoice_data['items']}
+            # Nothing here needs them again.
+            totals.invoices.clear()
+
+
+def csv_rows(record):
+    """ An exported record as rows of EXPORT_CSV_COLUMNS: an entry and a row
+    per range, or an invoice and a row per bill code.
+
+    >>> for row in csv_rows({'record': 'invoice', 'file': 'x.txt', 'line': 9, 'client': 'ACME', 'date': '2015-06-30',
+    ...         'invoice': 'ACME01', 'description': 'June', 'hours': 3.5, 'items': [{'billcode': 'IMPL', 'hours': 3.5}]}):
+    ...     print(row)
+    ['invoice', 'x.txt', 9, 'ACME', '2015-06-30', '', 3.5, '', '', 'June', 'ACME01']
+    ['invoice_item', 'x.txt', 9, 'ACME', '2015-06-30', 'IMPL', 3.5, '', '', '', 'ACME01']
+    """
+    head = [record['file'], record['line'], record['client'], record['date']]
+    if record['record'] == 'entry':
+        yield ['entry'] + head + [record['billcode'] or '', record['hours'], '', '', record['comment'], '']
+        for r in record['ranges'] or ():
+            yield ['range'] + head + [record['billcode'] or '', r['hours'], r['start'] or '', r['end'] or '', '', '']
+    else:
+        yield ['invoice'] + head + ['', record['hours'], '', '', record['description'], record['invoice']]
+        for item in record['items']:
+            yield ['invoice_item'] + head + [item['billcode'], item['hours'], '', '', '', record['invoice']]
+
+
+# Watch mode.  Directories (not files, which editors often replace by
+# renaming a new copy over them) are watched with inotify where available,
+# or else polled.  Saves are debounced, and the parse cache means each
+# rebuild only re-parses what changed.
+WATCH_DEBOUNCE = 0.3
+WATCH_POLL_INTERVAL = 0.5
+WATCH_IGNORED_SUFFIXES = ('.temp', '.tscache', '.tssnap', '.swp', '~')
+
+IN_CLOSE_WRITE = 0x08
+IN_MOVED_TO = 0x80
+INOTIFY_EVENT = struct.Struct('iIII')  # wd, mask, cookie, len; then len bytes of name
+
+
+class InotifyWatcher:
+    """ Changed files in some directories, from Linux inotify (through ctypes). """
+    def __init__(self, directories):
+        import ctypes, ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.directories = {}
+        for directory in directories:
+            wd = libc.inotify_add_watch(self.fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO)
+            if wd < 0:
+                os.close(self.fd)
+                raise OSError(ctypes.get_errno(), 'inotify_add_watch failed', directory)
+            self.directories[wd] = directory
+
+    def wait(self, timeout=None):
+        """ Paths written (or moved into place) within timeout seconds. """
+        import select
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return set()
+        data = os.read(self.fd, 64 * 1024)
+        changed, offset = set(), 0
+        while offset < len(data):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if wd in self.directories and name:
+                changed.add(os.path.join(self.directories[wd], os.fsdecode(name)))
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """ Changed files in some directories, by comparing os.stat() every so often. """
+    def __init__(self, directories, interval=WATCH_POLL_INTERVAL):
+        self.directories = list(directories)
+        self.interval = interval
+        self.stats = self.scan()
+
+    def scan(self):
+        stats = {}
+        for directory in self.directories:
+            for entry in os.scandir(directory):
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                stats[entry.path] = (st.st_size, st.st_mtime_ns)
+        return stats
+
+    def wait(self, timeout=None):
+        time.sleep(self.interval if timeout is None else min(timeout, self.interval))
+        stats = self.scan()
+        changed = {path for path, st in stats.items() if self.stats.get(path) != st}
+        self.stats = stats
+        return changed
+
+    def close(self):
+        pass
+
+
+def make_watcher(directories, polling=False):
+    if not polling and sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(directories)
+        except (OSError, AttributeError) as e:
+            logger.warning("inotify unavailable ({}), polling instead".format(e))
+    return PollingWatcher(directories)
+
+
+def watch(paths, options, pattern='*.txt', polling=False, debounce=WATCH_DEBOUNCE):
+    """ Reprocess timesheets whenever they're saved, until interrupted.
+
+    paths are timesheets, or directories whose timesheets matching pattern
+    are all watched (including ones created later).
+    """
+    import fnmatch
+    files = {os.path.abspath(p) for p in paths if not os.path.isdir(p)}
+    directories = {os.path.abspath(p) for p in paths if os.path.isdir(p)}
+
+    def is_timesheet(path):
+        name = os.path.basename(path)
+        if name.startswith('.') or name.endswith(WATCH_IGNORED_SUFFIXES) or BACKUP_REGEX.search(name):
+            return False
+        return path in files or (os.path.dirname(path) in directories and fnmatch.fnmatch(name, pattern))
+
+    watcher = make_watcher(directories | {os.path.dirname(f) for f in files}, polling=polling)
+    print("Watching {} for changes (^C to stop)...".format(", ".join(sorted(files | directories))))
+
+    written = {}  # path -> (size, mtime_ns) of our own last write to it
+    pending = {}  # path -> when its burst of writes will have settled
+    try:
+        while True:
+            timeout = max(0., min(pending.values()) - time.monotonic()) if pending else None
+            changed = watcher.wait(timeout)
+            now = time.monotonic()
+            for path in changed:
+                if is_timesheet(path):
+                    pending[path] = now + debounce
+
+            for path in [path for path, due in pending.items() if due <= now]:
+                del pending[path]
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if written.get(path) == (st.st_size, st.st_mtime_ns):
+                    continue
 
+                print("== {} changed, reprocessing".format(path))
+                try:
+                    process_file(path, **options)
+                except (Exception, SystemExit):
+                    logger.exception("Crash while processing timesheet {}.".format(path))
+                try:
+                    st = os.stat(path)
+                    written[path] = (st.st_size, st.st_mtime_ns)
+                except OSError:
+                    pass
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+
+def report_command(argv):
+    """ ts.py report: hours and revenue of timesheets, by week, month, quarter, billcode and/or client. """
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='ts.py report', description='Report hours and revenue over timesheets')
+    parser.add_argument('file', metavar='FILE', nargs='+')
+    parser.add_argument('--by', default='month',
+        help='Comma-separated groupings, from week (ISO), month, quarter, billcode and client. Defaults to month.')
+    parser.add_argument('--format', choices=['text', 'csv'], default='text')
+    parser.add_argument('--parser', choices=sorted(LINE_SCANNERS), default=None)
+    args = parser.parse_args(argv)
+
+    try:
+        import report
+    except ImportError as e:
+        parser.error('report needs NumPy ({})'.format(e))
+    by = args.by.split(',')
+    for grouping in by:
+        if grouping not in report.GROUPINGS:
+            parser.error('unknown grouping {!r}'.format(grouping))
+
+    row_lists = []
+    for filename in args.file:
+        # Keep settings chatter out of the report itself.
+        with redirect_stdout(sys.stderr):
+            settings, store = load_snapshot(filename, parser=args.parser)
+        rates = report.entry_rates(store, {settings.get('client_name'): settings})
+        header, rows = report.rollup(store, rates, by)
+        row_lists.append(rows)
+    rows = report.merge_rows(row_lists)
+    if args.format == 'csv':
+        sys.stdout.write(report.format_csv(header, rows))
+    else:
+        print(report.format_text(header, rows))
+
+
+def snapshot_command(argv):
+    """ ts.py snapshot: bring the binary snapshots of timesheets up to date. """
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='ts.py snapshot', description='Write .FILE.tssnap binary snapshots')
+    parser.add_argument('file', metavar='FILE', nargs='+')
+    args = parser.parse_args(argv)
+
+    for filename in args.file:
+        settings, store = load_snapshot(filename)
+        print('{}: {} entries, {} markers'.format(snapshot_filename(filename), len(store), len(store.boundary_rows)))
+
+
+def index_command(argv):
+    """ ts.py index: add timesheets to (or refresh them in) the SQLite index. """
+    import argparse
+    import tsindex
+
+    parser = argparse.ArgumentParser(prog='ts.py index', description='Update the SQLite index of timesheets')
+    parser.add_argument('file', metavar='FILE', nargs='*')
+    parser.add_argument('--index', default=tsindex.DEFAULT_INDEX, help='Defaults to {}.'.format(tsindex.DEFAULT_INDEX))
+    args = parser.parse_args(argv)
+
+    # A file's digest in the index covers the config files too, as its settings come from them.
+    config = config_digest()
+    conn = tsindex.connect(args.index)
+    with conn:
+        for (path,) in conn.execute('SELECT path FROM files').fetchall():
+            if not os.path.exists(path):
+                print('{}: gone, removing'.format(path))
+                tsindex.remove_file(conn, path)
+
+        for filename in args.file:
+            path = os.path.abspath(filename)
+            st = os.stat(path)
+            indexed = tsindex.file_state(conn, path)
+            if indexed is not None and indexed[:2] == (st.st_size, st.st_mtime_ns) and indexed[2][16:] == config:
+                continue
+            with open(path, 'rb') as f:
+                state = (st.st_size, st.st_mtime_ns, source_digest(f.read()) + config)
+            if indexed is not None and indexed[2] == state[2]:
+                tsindex.touch_file(conn, path, state)
+                continue
+
+            with redirect_stdout(sys.stderr):
+                settings, store = load_snapshot(path)
+            tsindex.replace_file(conn, path, state, settings, store)
+            print('{}: {} entries'.format(path, len(store)))
+    conn.close()
+
+
+def query_command(argv):
+    """ ts.py query: answer questions across every indexed timesheet, without parsing any. """
+    import argparse
+    import tsindex
+
+    parser = argparse.ArgumentParser(prog='ts.py query', description='Query the SQLite index of timesheets. '
+        'Lists matching entries, unless --uninvoiced or --sql is given.')
+    parser.add_argument('--index', default=tsindex.DEFAULT_INDEX, help='Defaults to {}.'.format(tsindex.DEFAULT_INDEX))
+    parser.add_argument('--date', help='Only entries on this date (YYYY-MM-DD).')
+    parser.add_argument('--since', help='Only entries on or after this date.')
+    parser.add_argument('--until', help='Only entries on or before this date.')
+    parser.add_argument('--client')
+    parser.add_argument('--billcode')
+    parser.add_argument('--uninvoiced', action='store_true', help='Total uninvoiced hours by client.')
+    parser.add_argument('--sql', help='Run this SQL against the index instead.')
+    parser.add_argument('--format', choices=['text', 'csv'], default='text')
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(os.path.expanduser(args.index)):
+        parser.error("no index at {}; build one with 'ts.py index FILE...'".format(args.index))
+    conn = tsindex.connect(args.index)
+    filters = dict(date=args.date, since=args.since, until=args.until, client=args.client, billcode=args.billcode)
+    if args.sql:
+        (header, rows), total = tsindex.query_sql(conn, args.sql), None
+    elif args.uninvoiced:
+        (header, rows), total = tsindex.query_uninvoiced(conn, **filters), 1
+    else:
+        (header, rows), total = tsindex.query_entries(conn, **filters), 3
+    conn.close()
+
+    if args.format == 'csv':
+        sys.stdout.write(tsindex.format_csv(header, rows))
+    else:
+        print(tsindex.format_rows(header, rows, total))
+
+
+def overlaps_command(argv):
+    """ ts.py overlaps: find time billed twice, within or across timesheets.  Exits 1 if there is any. """
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='ts.py overlaps', description='Find overlapping time ranges across '
+        'timesheets, e.g. before invoicing. Exits with status 1 if there are any.')
+    parser.add_argument('file', metavar='FILE', nargs='+')
+    parser.add_argument('--parser', choices=sorted(LINE_SCANNERS), default=None)
+    args = parser.parse_args(argv)
+
+    ranges = []
+    for filename in args.file:
+        with open(filename) as f, redirect_stdout(sys.stderr):
+            ranges.extend(timed_ranges(f, filename, parser=args.parser))
+    overlaps = find_overlaps(ranges)
+    for overlap in overlaps:
+        print(format_overlap(overlap))
+    print('{} overlapping ranges, among {} ranges in {} timesheets.'.format(len(overlaps), len(ranges),
+        len(args.file)))
+    return 1 if overlaps else 0
+
+
+def export_command(argv):
+    """ ts.py export: stream the parsed entries and invoices of timesheets out as JSON Lines or CSV. """
+    import argparse, csv
+
+    parser = argparse.ArgumentParser(prog='ts.py export', description='Export parsed entries (with their ranges) '
+        'and invoices (with their items) of timesheets, in order')
+    parser.add_argument('file', metavar='FILE', nargs='+')
+    parser.add_argument('--format', choices=['jsonl', 'csv'], default='jsonl')
+    parser.add_argument('-o', '--out', default=None, help='Defaults to stdout.')
+    parser.add_argument('--parser', choices=sorted(LINE_SCANNERS), default=None)
+    args = parser.parse_args(argv)
+
+    with ExitStack() as stack:
+        if args.out is None:
+            outf = sys.stdout
+        else:
+            outf = stack.enter_context(open(args.out, 'w', newline='', buffering=1024 * 1024))
+        if args.format == 'csv':
+            writer = csv.writer(outf, lineterminator='\n')
+            writer.writerow(EXPORT_CSV_COLUMNS)
+        for filename in args.file:
+            with open(filename) as f, redirect_stdout(sys.stderr):
+                # Settings chatter goes to stderr; records are written to outf directly.
+                for record in export_records(f, filename, parser=args.parser):
+                    if args.format == 'csv':
+                        writer.writerows(csv_rows(record))
+                    else:
+                        outf.write(json.dumps(record) + '\n')
+
+
+def invoices_command(argv):
+    """ ts.py invoices: render the invoices of many timesheets into one PDF, a page each. """
+    import argparse
+    from invoice import draw_pdfs, has_fingerprint
+
+    parser = argparse.ArgumentParser(prog='ts.py invoices', description='Render the invoices of timesheets '
+        '(e.g. every client, for a quarter) into one multi-page PDF')
+    parser.add_argument('file', metavar='FILE', nargs='+')
+    parser.add_argument('-o', '--out', required=True, help='The PDF to write.')
+    parser.add_argument('--since', help='Only invoices whose last entry is on or after this date (YYYY-MM-DD).')
+    parser.add_argument('--until', help='Only invoices whose last entry is on or before this date.')
+    parser.add_argument('--force', action='store_true', help='Redraw the PDF even if its invoices are unchanged.')
+    parser.add_argument('--parser', choices=sorted(LINE_SCANNERS), default=None)
+    args = parser.parse_args(argv)
+
+    invoices, fingerprints, failed = [], [], []
+    for filename in args.file:
+        with open(filename) as f, redirect_stdout(sys.stderr):
+            settings, front_matter = load_front_matter(f)
+            if args.parser is not None:
+                settings['parser'] = args.parser
+            for record in body_records(f, filename, settings, len(front_matter) + 2):
+                if record['record'] != 'invoice' or (args.since and record['date'] < args.since) or \
+                        (args.until and record['date'] > args.until):
+                    continue
+                i = {'id': record['invoice'], 'hours': record['hours'], 'items': record['items'],
+                    'description': record['description']}
+                fingerprint = invoice_fingerprint(i, settings)
+                try:
+                    invoices.append(make_invoice(i, settings, fingerprint))
+                except Exception:
+                    logger.exception('{}:{}: failed to lay out invoice {}'.format(filename, record['line'], i['id']))
+                    failed.append(i['id'])
+                    continue
+                fingerprints.append(fingerprint)
+
+    if failed:
+        print('Skipped {} invoices that failed: {}'.format(len(failed), ', '.join(failed)))
+    if not invoices:
+        print('No invoices to render.')
+        return 1
+    fingerprint = hashlib.blake2b(''.join(fingerprints).encode('ascii'), digest_size=16).hexdigest()
+    if not args.force and has_fingerprint(args.out, fingerprint):
+        print('{} invoices are unchanged, skipping {}'.format(len(invoices), args.out))
+        return 0
+    draw_pdfs(args.out, invoices, fingerprint)
+    print('Wrote {} invoices to {}'.format(len(invoices), args.out))
+    return 1 if failed else 0
+
+
+# Subcommands, as in 'ts.py report FILE...'.  Anything else is a timesheet to process.
+COMMANDS = {
+    'report': report_command,
+    'snapshot': snapshot_command,
+    'index': index_command,
+    'query': query_command,
+    'overlaps': overlaps_command,
+    'export': export_command,
+    'invoices': invoices_command,
+}
+
+
+if __name__=='__main__':
+    import argparse, glob
+
+    logging.basicConfig(level=logging.DEBUG)
+
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        sys.exit(COMMANDS[sys.argv[1]](sys.argv[2:]))
+
+    parser = argparse.ArgumentParser(description='Process a timesheet')
+    parser.add_argument('file', metavar='FILE', nargs='*')
+    parser.add_argument('--batch', metavar='DIR', default=None,
+        help='Process every timesheet in DIR (see --glob) in parallel.')
+    parser.add_argument('--glob', default='*.txt', help="Timesheet filename pattern for --batch, or directories with --watch. Defaults to '*.txt'.")
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+        help='Worker processes for several FILEs or --batch. Defaults to the number of CPUs.')
+    parser.add_argument('--parse-jobs', type=int, default=None,
+        help='Worker processes for parsing a single FILE; 1 parses serially. By default, '
+            'only files over {}MB are parsed in parallel.'.format(PARALLEL_PARSE_MIN_BYTES // (1024 * 1024)))
+    parser.add_argument('-v', '--verbose', action='count', default=None)
+    parser.add_argument('-i', '--invoice', action='store_true', help='Write PDF invoice.')
+    parser.add_argument('--force', action='store_true',
+        help='With -i, redraw every invoice, even those whose PDF is unchanged.')
+    parser.add_argument('--invoice-jobs', type=int, default=None,
+        help='Worker processes for rendering invoice PDFs; 1 renders serially. Defaults to the number of CPUs.')
+    parser.add_argument('-o', '--out', default=None, help="Defaults to overwrite -f FILE.")
+    parser.add_argument('--backups', type=int, default=BACKUPS, metavar='N',
+        help='Keep the last N versions of a rewritten timesheet as FILE.backup, FILE.backup.1, ...; 0 keeps none. '
+            'Defaults to {}.'.format(BACKUPS))
+    parser.add_argument('--no-cache', action='store_true',
+        help="Don't read or write the .FILE.tscache sidecar parse cache.")
+    parser.add_argument('--parser', choices=sorted(LINE_SCANNERS), default=None,
+        help="Line parser engine; 'grammar' is the original modgrammar parser. Defaults to 'fast'.")
+    parser.add_argument('--profile', action='store_true',
+        help='Time each stage of a (serial) run, count lines by outcome, and print a table of it.')
+    parser.add_argument('--profile-json', metavar='FILE', default=None, help='Like --profile, but write JSON to FILE.')
+    parser.add_argument('--tail', action='store_true',
+        help='Only process what follows the last invoice line, copying everything before it as is.')
+    parser.add_argument('--watch', action='store_true',
+        help='Keep running, reprocessing each FILE (or each --glob timesheet in a FILE that is a directory) '
+            'shortly after it is saved.')
+    parser.add_argument('--poll', action='store_true', help="With --watch, poll for changes instead of using inotify.")
+    parser.add_argument('--lines', metavar='START:END', type=parse_line_range, default=None,
+        help="With FILE '-', only reformat these lines (1-based, inclusive), copying the rest as is.")
+    parser.add_argument('--stdin-filename', metavar='FILE', default=None,
+        help="With FILE '-', the timesheet being filtered, whose parse cache lets --lines skip the lines before them.")
+
+    args = parser.parse_args()
+
+    if args.file == ['-']:
+        if (args.batch is not None or args.out is not None or args.invoice or args.tail or args.watch or
+                args.profile or args.profile_json):
+            parser.error("FILE '-' filters stdin to stdout; it only takes -v, --parser, --lines and --stdin-filename")
+        cache_filename = None
+        if args.stdin_filename is not None and not args.no_cache:
+            cache_filename = sidecar_cache_filename(args.stdin_filename)
+        success = filter_timesheet(sys.stdin, sys.stdout, args.lines, verbose=args.verbose, parser=args.parser,
+            cache_filename=cache_filename)
+        sys.exit(0 if success else 1)
+    if '-' in args.file:
+        parser.error("FILE '-' can't be combined with other timesheets")
+    if args.lines is not None or args.stdin_filename is not None:
+        parser.error("--lines and --stdin-filename only work with FILE '-'")
+
+    if args.watch:
+        if not args.file and args.batch is None:
+            parser.error('no timesheets given')
+        if args.out is not None or args.profile or args.profile_json:
+            parser.error('--watch rewrites timesheets in place; it does not take -o or --profile')
+        options = dict(verbose=args.verbose, invoice=args.invoice, parser=args.parser, use_cache=not args.no_cache,
+            force_invoices=args.force, parse_jobs=args.parse_jobs, invoice_jobs=args.invoice_jobs,
+            backups=args.backups)
+        watch(args.file + ([args.batch] if args.batch is not None else []), options, args.glob, polling=args.poll)
+        sys.exit(0)
+
+    filenames = list(args.file)
+    if args.batch is not None:
+        filenames += sorted(glob.glob(os.path.join(args.batch, args.glob)))
+    if not filenames:
+        parser.error('no timesheets given')
+    if args.out is not None and len(filenames) > 1:
+        parser.error('-o/--out only works with a single FILE')
+    if (args.profile or args.profile_json) and (len(filenames) > 1 or args.batch is not None):
+        parser.error('--profile only works with a single FILE')
+    if args.tail and (len(filenames) > 1 or args.batch is not None or args.out is not None or args.profile or
+            args.profile_json):
+        parser.error('--tail only works with a single FILE, in place')
+
+    options = dict(verbose=args.verbose, invoice=args.invoice, parser=args.parser, use_cache=not args.no_cache,
+        force_invoices=args.force, backups=args.backups)
+    if args.tail:
+        process_file_tail(filenames[0], verbose=args.verbose, invoice=args.invoice, parser=args.parser,
+            invoice_jobs=args.invoice_jobs, force_invoices=args.force, backups=args.backups)
+    elif len(filenames) == 1 and args.batch is None:
+        profile = Profile() if args.profile or args.profile_json else None
+        process_file(filenames[0], args.out, parse_jobs=args.parse_jobs, invoice_jobs=args.invoice_jobs,
+            profile=profile, **options)
+        if args.profile:
+            print(profile.format_table())
+        if args.profile_json:
+            with open(args.profile_json, 'w') as f:
+                json.dump(profile.as_dict(), f, indent=2)
+                f.write('\n')
+    else:
+        results = process_batch(filenames, options, jobs=args.jobs)
+        if not all(result.success for result in results):
+            sys.exit(1)
@@ -0,0 +1,96 @@
+""" Client for the resident tsserver.py, for editor integrations.
+
+Only the standard library is imported here, so asking the (already warm)
+server costs little more than starting Python:
+
+    python tsclient.py format '2015-06-03  1.5  10a-11:15a # whatever' --file clientx-hours.txt
+    python tsclient.py totals clientx-hours.txt
+    python tsclient.py process clientx-hours.txt
+
+The protocol is one JSON object per line each way: a request
+{"op": ..., ...params} is answered by {"ok": true, "result": ...} or
+{"ok": false, "error": "..."}, echoing the request's "id" if it had one.
+"""
+import argparse, json, os, socket, sys
+
+
+def default_socket():
+    """ $TS_SOCKET, or ts-UID.sock in $XDG_RUNTIME_DIR (or $TMPDIR, or /tmp). """
+    if os.environ.get('TS_SOCKET'):
+        return os.environ['TS_SOCKET']
+    directory = os.environ.get('XDG_RUNTIME_DIR') or os.environ.get('TMPDIR') or '/tmp'
+    return os.path.join(directory, 'ts-{}.sock'.format(os.getuid()))
+
+
+class ServerError(Exception):
+    pass
+
+
+class Client:
+    """ A connection to the server, which can make any number of requests. """
+    def __init__(self, path=None, timeout=60.):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(path or default_socket())
+        self.file = self.sock.makefile('rwb')
+
+    def request(self, op, **params):
+        """ Returns the result, or raises ServerError. """
+        self.file.write(json.dumps(dict(params, op=op)).encode('utf-8') + b'\n')
+        self.file.flush()
+        line = self.file.readline()
+        if not line:
+            raise ServerError('server closed the connection')
+        response = json.loads(line)
+        if not response.get('ok'):
+            raise ServerError(response.get('error'))
+        return response.get('result')
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Ask the resident ts server (tsserver.py)')
+    parser.add_argument('--socket', default=None, help='Defaults to {}.'.format(default_socket()))
+    commands = parser.add_subparsers(dest='op', required=True)
+    for op, help in (('parse', 'Parse lines, printing them as JSON.'), ('format', 'Print lines canonicalized.')):
+        command = commands.add_parser(op, help=help)
+        command.add_argument('lines', metavar='LINE', nargs='+')
+        command.add_argument('--file', help="Use this timesheet's settings.")
+    command = commands.add_parser('totals', help="Print a timesheet's week, invoice and per-code totals.")
+    command.add_argument('file', metavar='FILE')
+    command = commands.add_parser('process', help='Process a timesheet in place, as ts.py FILE would.')
+    command.add_argument('file', metavar='FILE')
+    command.add_argument('-i', '--invoice', action='store_true')
+    command.add_argument('--force', action='store_true')
+    commands.add_parser('ping')
+    commands.add_parser('stats')
+    commands.add_parser('shutdown')
+    args = parser.parse_args()
+
+    params = {k: v for k, v in vars(args).items() if k not in ('op', 'socket') and v is not None}
+    if 'file' in params:
+        params['file'] = os.path.abspath(params['file'])
+    try:
+        with Client(args.socket) as client:
+            result = client.request(args.op, **params)
+    except OSError as e:
+        sys.exit("Can't reach the ts server at {}: {}".format(args.socket or default_socket(), e))
+    except ServerError as e:
+        sys.exit('Error: {}'.format(e))
+
+    if args.op == 'format':
+        print('\n'.join(result))
+    elif args.op == 'process':
+        sys.stdout.write(result['output'])
+        sys.exit(0 if result['success'] else 1)
+    else:
+        print(json.dumps(result, indent=2))
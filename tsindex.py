@@ -0,0 +1,225 @@
+""" SQLite index of parsed timesheets, for `ts.py index` and `ts.py query`.
+
+Each timesheet's entries, ranges, summary/invoice markers and invoices are
+stored from its EntryStore, keyed by path, and only replaced when the file's
+content changes, so questions across every contract can be answered without
+parsing any text.
+
+    >>> import ts
+    >>> store = ts.EntryStore()
+    >>> for line in ['2015-06-29 IMPL 2', '2015-06-30 ARCH 9a-10:30a # design']:
+    ...     store.append(ts.parse(line, prefix=''), client='ACME')
+    >>> store.add_boundary(ts.BOUNDARY_INVOICE, '==== # ACME01, June')
+    >>> store.append(ts.parse('2015-07-01 IMPL .5', prefix=''), client='ACME')
+    >>> conn = connect(':memory:')
+    >>> with conn:
+    ...     replace_file(conn, '/x.txt', (1, 1, b'digest'), {'client_name': 'ACME'}, store)
+    >>> query_entries(conn, date='2015-06-30')[1]
+    [('2015-06-30', 'ACME', 'ARCH', 1.5, 'design', 'ACME01')]
+    >>> query_uninvoiced(conn)[1]
+    [('ACME', 0.5)]
+    >>> conn.execute('SELECT invoice_code, description, hours FROM invoices').fetchall()
+    [('ACME01', 'June', 3.5)]
+"""
+import csv, io, os, sqlite3
+from datetime import date
+
+DEFAULT_INDEX = '~/.tsindex.sqlite'
+
+# Bump whenever SCHEMA changes; an index from another version is rebuilt.
+SCHEMA_VERSION = 1
+SCHEMA = """
+CREATE TABLE files (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    client TEXT,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    digest BLOB NOT NULL  -- of the file, then of the config files (ts.config_digest())
+);
+CREATE TABLE invoices (
+    id INTEGER PRIMARY KEY,
+    file_id INTEGER NOT NULL REFERENCES files(id),
+    client TEXT,
+    invoice_code TEXT,
+    description TEXT,
+    hours REAL NOT NULL
+);
+CREATE TABLE entries (
+    id INTEGER PRIMARY KEY,
+    file_id INTEGER NOT NULL REFERENCES files(id),
+    invoice_id INTEGER REFERENCES invoices(id),  -- NULL while uninvoiced
+    date TEXT NOT NULL,
+    client TEXT,
+    billcode TEXT,
+    hours REAL,
+    comment TEXT
+);
+CREATE TABLE ranges (
+    entry_id INTEGER NOT NULL REFERENCES entries(id),
+    start TEXT,  -- 'HH:MM', or NULL for a bare duration
+    end TEXT,
+    hours REAL
+);
+CREATE TABLE summaries (
+    file_id INTEGER NOT NULL REFERENCES files(id),
+    entries_before INTEGER NOT NULL,
+    kind TEXT NOT NULL,  -- 'summary' or 'invoice'
+    label TEXT,
+    hours REAL NOT NULL  -- since the previous marker
+);
+CREATE INDEX entries_date ON entries(date);
+CREATE INDEX entries_client ON entries(client);
+CREATE INDEX entries_billcode ON entries(billcode);
+CREATE INDEX entries_file ON entries(file_id);
+CREATE INDEX ranges_entry ON ranges(entry_id);
+CREATE INDEX invoices_file ON invoices(file_id);
+CREATE INDEX summaries_file ON summaries(file_id);
+"""
+
+BOUNDARY_KINDS = {1: 'summary', 2: 'invoice'}  # ts.BOUNDARY_SUMMARY, ts.BOUNDARY_INVOICE
+
+
+def connect(filename=DEFAULT_INDEX):
+    """ Open (creating, or rebuilding if outdated) the index at filename. """
+    if filename != ':memory:':
+        filename = os.path.expanduser(filename)
+    conn = sqlite3.connect(filename)
+    if conn.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+        with conn:
+            for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall():
+                conn.execute('DROP TABLE {}'.format(name))
+            conn.executescript(SCHEMA)
+            conn.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+    return conn
+
+
+def file_state(conn, path):
+    """ The (size, mtime_ns, digest) path was indexed at, or None. """
+    return conn.execute('SELECT size, mtime_ns, digest FROM files WHERE path = ?', (path,)).fetchone()
+
+
+def touch_file(conn, path, state):
+    conn.execute('UPDATE files SET size = ?, mtime_ns = ?, digest = ? WHERE path = ?', tuple(state) + (path,))
+
+
+def remove_file(conn, path):
+    row = conn.execute('SELECT id FROM files WHERE path = ?', (path,)).fetchone()
+    if row is None:
+        return
+    file_id = row[0]
+    conn.execute('DELETE FROM ranges WHERE entry_id IN (SELECT id FROM entries WHERE file_id = ?)', (file_id,))
+    for table in ('entries', 'summaries', 'invoices'):
+        conn.execute('DELETE FROM {} WHERE file_id = ?'.format(table), (file_id,))
+    conn.execute('DELETE FROM files WHERE id = ?', (file_id,))
+
+
+def clock(minutes):
+    return None if minutes < 0 else '{:02d}:{:02d}'.format(minutes // 60, minutes % 60)
+
+
+def comment(suffix):
+    return suffix.split('#', 1)[1].strip() if suffix and '#' in suffix else None
+
+
+def replace_file(conn, path, state, settings, store):
+    """ (Re)index the timesheet at path, with state (size, mtime_ns, digest),
+    from its settings and EntryStore.  Call inside a transaction.
+    """
+    remove_file(conn, path)
+    client = settings.get('client_name')
+    file_id = conn.execute('INSERT INTO files (path, client, size, mtime_ns, digest) VALUES (?, ?, ?, ?, ?)',
+        (path, client) + tuple(state)).lastrowid
+
+    hours = [0. if h != h else h for h in store.hours]
+    boundaries = store.boundaries()
+
+    # Entries before each invoice marker belong to that invoice; the rest are uninvoiced.
+    summaries, invoice_ids = [], [None] * len(store)
+    last_row, last_invoice_row = 0, 0
+    for row, kind, label in boundaries:
+        summaries.append((file_id, row, BOUNDARY_KINDS[kind], label, sum(hours[last_row:row])))
+        last_row = row
+        if BOUNDARY_KINDS[kind] == 'invoice':
+            code, _, description = label.partition(',')
+            invoice_id = conn.execute('INSERT INTO invoices (file_id, client, invoice_code, description, hours) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (file_id, client, code.strip(), description.strip(), sum(hours[last_invoice_row:row]))).lastrowid
+            invoice_ids[last_invoice_row:row] = [invoice_id] * (row - last_invoice_row)
+            last_invoice_row = row
+    conn.executemany('INSERT INTO summaries VALUES (?, ?, ?, ?, ?)', summaries)
+
+    first_id = conn.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM entries').fetchone()[0]
+    strings = store.strings
+    string = lambda i: None if i < 0 else strings[i]
+    conn.executemany('INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (
+        (first_id + i, file_id, invoice_ids[i], date.fromordinal(store.dates[i]).isoformat(), string(store.clients[i]),
+            string(store.billcodes[i]), None if store.hours[i] != store.hours[i] else store.hours[i],
+            comment(string(store.suffixes[i])))
+        for i in range(len(store))))
+
+    def ranges():
+        for i in range(len(store)):
+            offset = store.range_offsets[i]
+            for j in range(offset, offset + store.range_counts[i]) if offset >= 0 else ():
+                duration = store.range_hours[j]
+                yield (first_id + i, clock(store.range_starts[j]), clock(store.range_ends[j]),
+                    None if duration != duration else duration)
+    conn.executemany('INSERT INTO ranges VALUES (?, ?, ?, ?)', ranges())
+
+
+def where(date=None, since=None, until=None, client=None, billcode=None):
+    clauses, params = [], []
+    for clause, value in (('e.date = ?', date), ('e.date >= ?', since), ('e.date <= ?', until),
+            ('e.client = ?', client), ('e.billcode = ?', billcode)):
+        if value is not None:
+            clauses.append(clause)
+            params.append(value)
+    return (' WHERE ' + ' AND '.join(clauses) if clauses else ''), params
+
+
+def query_entries(conn, **filters):
+    """ Matching entries, as (header, rows). """
+    sql, params = where(**filters)
+    rows = conn.execute('SELECT e.date, e.client, e.billcode, e.hours, e.comment, i.invoice_code FROM entries e '
+        'LEFT JOIN invoices i ON i.id = e.invoice_id' + sql + ' ORDER BY e.date, e.client, e.id', params).fetchall()
+    return ['date', 'client', 'billcode', 'hours', 'comment', 'invoice'], rows
+
+
+def query_uninvoiced(conn, **filters):
+    """ Uninvoiced hours of matching entries by client, as (header, rows). """
+    sql, params = where(**filters)
+    sql = (sql + ' AND' if sql else ' WHERE') + ' e.invoice_id IS NULL'
+    rows = conn.execute('SELECT e.client, SUM(e.hours) FROM entries e' + sql + ' GROUP BY e.client ORDER BY e.client',
+        params).fetchall()
+    return ['client', 'uninvoiced hours'], rows
+
+
+def query_sql(conn, sql):
+    cursor = conn.execute(sql)
+    return [d[0] for d in cursor.description or ()], cursor.fetchall()
+
+
+def format_rows(header, rows, total=None):
+    """ Rows as an aligned text table, with a total line for column total if given. """
+    def cell(value):
+        if value is None:
+            return ''
+        if isinstance(value, float):
+            return '{:.2f}'.format(value)
+        return str(value)
+
+    table = [header] + [[cell(value) for value in row] for row in rows]
+    if total is not None and rows:
+        table.append(['total'] + [''] * (total - 1) + [cell(sum(row[total] or 0 for row in rows))] +
+            [''] * (len(header) - total - 1))
+    widths = [max(len(line[i]) for line in table) for i in range(len(header))]
+    return '\n'.join('  '.join(c.ljust(w) for c, w in zip(line, widths)).rstrip() for line in table)
+
+
+def format_csv(header, rows):
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator='\n')
+    writer.writerow(header)
+    writer.writerows(rows)
+    return out.getvalue()
@@ -0,0 +1,316 @@
+""" Resident ts server: answers parse, format and whole-file requests over a
+Unix domain socket, so editor integrations don't pay for starting Python,
+loading YAML and warming ts.py's caches on every keystroke.
+
+    python tsserver.py [--socket PATH] [--max-clients 16] [--jobs 4]
+
+and then ask it with tsclient.py (or anything that can write a line of JSON
+to a socket; see tsclient.py for the protocol).  Requests:
+
+    ping                            -> {"pid": ..., "uptime": ...}
+    parse   lines=[...] [file=PATH] -> a parsed entry (or null) per line
+    format  lines=[...] [file=PATH] -> each line as ts.py would write it
+    totals  file=PATH               -> hours this week and since the last invoice, per code, and invoices
+    process file=PATH [invoice=true] [force=true] -> process the file in place, as `ts.py FILE` would
+    stats                           -> request counts and warm files
+    shutdown
+
+With file, lines are read with that timesheet's settings (its front matter,
+~/.tsconfig.yml and the server's default.yml); without, with the defaults.
+Each file's settings and parsed lines are kept warm, and only reloaded when
+the file changes.
+
+At most --max-clients connections are served at once (others are told the
+server is busy), and at most --jobs requests run at once.  Whole-file
+requests for the same file run one at a time.
+
+    >>> server = Server()
+    >>> server.handle({'id': 1, 'op': 'format', 'lines': ['6/1/2015 IMPL 9a-10:30a  # standup']})
+    {'id': 1, 'ok': True, 'result': ['2015-06-01 IMPL  1.50 9a-10:30a(1.50) # standup']}
+    >>> server.handle({'op': 'parse', 'lines': ['not an entry']})
+    {'ok': True, 'result': [None]}
+    >>> server.handle({'op': 'frobnicate'})
+    {'ok': False, 'error': "unknown op 'frobnicate'"}
+"""
+import argparse, json, logging, os, signal, socket, socketserver, sys, threading, time
+
+import ts
+from tsclient import default_socket
+
+logger = logging.getLogger(__name__)
+
+MAX_CLIENTS = 16
+JOBS = 4
+
+
+def item_json(ret):
+    """ A TimesheetLineItem as JSON-able data, or None. """
+    if ret is None:
+        return None
+    ranges = None
+    if ret.ranges is not None:
+        ranges = []
+        for r in ret.ranges:
+            start, end = r.get('s'), r.get('e')
+            ranges.append({'start': start.strftime('%H:%M') if start is not None else None,
+                'end': end.strftime('%H:%M') if end is not None else None, 'hours': r['duration']})
+    return {'date': ret.date.isoformat(), 'prefix': ret.prefix, 'suffix': ret.suffix, 'billcode': ret.billcode,
+        'hours': ret.hours, 'ranges': ranges}
+
+
+class WarmFile:
+    """ What the server knows about one timesheet, as of its (size, mtime_ns). """
+    def __init__(self, filename):
+        self.filename = filename
+        self.stat_key = None
+        self.settings = None
+        self.fingerprint = None
+        self.lines = {}   # line -> TimesheetLineItem, None, or the TimesheetSyntaxError it raised
+        self.totals = None
+        self.lock = threading.Lock()
+
+    def parse(self, line, settings):
+        """ ts.parse(), remembering each line's outcome. """
+        try:
+            ret = self.lines[line]
+        except KeyError:
+            try:
+                ret = ts.parse(line, settings)
+            except ts.TimesheetSyntaxError as e:
+                ret = e
+            self.lines[line] = ret
+        if isinstance(ret, Exception):
+            raise ret
+        return ret
+
+
+class Server:
+    """ The request handlers, independent of the socket. """
+    def __init__(self, jobs=JOBS):
+        self.started = time.time()
+        self.jobs = threading.BoundedSemaphore(jobs)
+        self.files = {}
+        self.files_lock = threading.Lock()
+        self.counts = {}
+        self.stopping = False
+
+    def handle(self, request):
+        """ Answer one request (a dict), returning the response (a dict). """
+        response = {'id': request['id']} if 'id' in request else {}
+        op = request.get('op')
+        handler = getattr(self, 'op_' + str(op), None)
+        if handler is None:
+            return dict(response, ok=False, error='unknown op {!r}'.format(op))
+        self.counts[op] = self.counts.get(op, 0) + 1
+        try:
+            with self.jobs:
+                result = handler(**{k: v for k, v in request.items() if k not in ('id', 'op')})
+        except (ts.TimesheetParseError, ts.InvoiceError, OSError, ValueError, TypeError, SystemExit) as e:
+            return dict(response, ok=False, error='{}: {}'.format(type(e).__name__, e))
+        except Exception as e:
+            logger.exception('Crash while handling %r', op)
+            return dict(response, ok=False, error='{}: {}'.format(type(e).__name__, e))
+        return dict(response, ok=True, result=result)
+
+    def warm_file(self, filename):
+        """ The WarmFile for filename, with its settings loaded if it has changed.
+        Call with its lock held.
+        """
+        warm = self.files[filename]
+        st = os.stat(filename)
+        stat_key = (st.st_size, st.st_mtime_ns)
+        if warm.stat_key != stat_key:
+            with open(filename) as f:
+                settings, _ = ts.read_front_matter(f, log=lambda message: None)
+            fingerprint = ts.settings_fingerprint(settings)
+            if fingerprint != warm.fingerprint:
+                warm.lines = {}
+            warm.stat_key, warm.settings, warm.fingerprint, warm.totals = stat_key, settings, fingerprint, None
+        return warm
+
+    def file_lock(self, filename):
+        with self.files_lock:
+            if filename not in self.files:
+                self.files[filename] = WarmFile(filename)
+            return self.files[filename].lock
+
+    def lines_with(self, lines, file, fn):
+        """ fn(line, settings, parse_line) for each line, with file's warm settings and lines if given. """
+        if file is None:
+            settings = ts.get_default_settings()
+            return [fn(line, settings, ts.parse) for line in lines]
+        file = os.path.abspath(file)
+        with self.file_lock(file):
+            warm = self.warm_file(file)
+            return [fn(line, warm.settings, warm.parse) for line in lines]
+
+    def op_ping(self):
+        return {'pid': os.getpid(), 'uptime': time.time() - self.started}
+
+    def op_parse(self, lines, file=None):
+        def parse(line, settings, parse_line):
+            try:
+                return item_json(parse_line(line, settings))
+            except ts.TimesheetSyntaxError:
+                return None
+        return self.lines_with(lines, file, parse)
+
+    def op_format(self, lines, file=None):
+        def format(line, settings, parse_line):
+            try:
+                ret = parse_line(line, settings)
+            except ts.TimesheetSyntaxError:
+                ret = None
+            return line.rstrip() if ret is None else ts.format_ret(ret, settings).rstrip()
+        return self.lines_with(lines, file, format)
+
+    def op_totals(self, file):
+        file = os.path.abspath(file)
+        with self.file_lock(file):
+            warm = self.warm_file(file)
+            if warm.totals is None:
+                warm.totals = self.totals(warm)
+            return warm.totals
+
+    def totals(self, warm):
+        settings = dict(warm.settings, verbose=0)
+        totals = ts.RunningTotals()
+        this_week = []
+        seen = set()
+
+        def parse_line(line, settings):
+            seen.add(line)
+            return warm.parse(line, settings)
+
+        def body(lines):
+            yield from lines
+            # Taken before aggregate_entries() closes out the week.
+            this_week.append(totals.weekly_hours)
+
+        with open(warm.filename) as f:
+            for line in f:
+                if ts.FRONT_MATTER_TERMINUS_REGEX.match(line):
+                    break
+            parsed = ts.parse_lines(ts.classify_lines(body(f), settings), settings, parse_line=parse_line)
+            for _ in ts.aggregate_entries(parsed, settings, totals):
+                pass
+
+        # Only keep the lines the file still has.
+        warm.lines = {line: warm.lines[line] for line in seen}
+        return {
+            'client_name': settings.get('client_name'),
+            'hours_this_week': this_week[0],
+            'hours_uninvoiced': totals.invoice_hours,
+            'hours_uninvoiced_per_code': dict(totals.invoice_hours_per_code),
+            'last_date': totals.last_date.isoformat() if totals.last_date is not None else None,
+            'invoices': totals.invoices,
+        }
+
+    def op_process(self, file, invoice=False, force=False):
+        file = os.path.abspath(file)
+        processor = ts.TimesheetProcessor(invoice=invoice, force_invoices=force)
+        with self.file_lock(file):
+            try:
+                result = processor.process_file(file)
+            except Exception:
+                logger.exception('Crash while processing %s', file)
+                return {'success': False, 'hours_uninvoiced': None,
+                    'output': 'Crash while processing timesheet.  The input failed to process (but is unharmed).\n'}
+        messages = result.messages + ["Success!" if result.changed else "Success! (unchanged, so not rewritten)"]
+        return {'success': True, 'hours_uninvoiced': result.hours_uninvoiced,
+            'output': ''.join(message + '\n' for message in messages)}
+
+    def op_stats(self):
+        with self.files_lock:
+            files = {filename: len(warm.lines) for filename, warm in self.files.items()}
+        return {'requests': dict(self.counts), 'files': files, 'pid': os.getpid()}
+
+    def op_shutdown(self):
+        self.stopping = True
+        return None
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        if not self.server.clients.acquire(blocking=False):
+            # Answer the first request, so the client hears why, and hang up.
+            self.rfile.readline()
+            self.send({'ok': False, 'error': 'server busy: {} clients connected'.format(self.server.max_clients)})
+            return
+        try:
+            for line in self.rfile:
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ValueError('not a JSON object')
+                except ValueError as e:
+                    self.send({'ok': False, 'error': 'bad request: {}'.format(e)})
+                    continue
+                self.send(self.server.app.handle(request))
+                if self.server.app.stopping:
+                    # Only once the reply is out, as serve_forever() returning ends the process.
+                    threading.Thread(target=self.server.shutdown).start()
+                    return
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            self.server.clients.release()
+
+    def send(self, response):
+        self.wfile.write(json.dumps(response, default=str).encode('utf-8') + b'\n')
+        self.wfile.flush()
+
+
+class UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, app, max_clients=MAX_CLIENTS):
+        self.app = app
+        self.max_clients = max_clients
+        self.clients = threading.BoundedSemaphore(max_clients)
+        remove_stale_socket(path)
+        # Only this user may talk to the server.
+        umask = os.umask(0o177)
+        try:
+            super().__init__(path, RequestHandler)
+        finally:
+            os.umask(umask)
+
+
+def remove_stale_socket(path):
+    """ Remove a socket left behind by a server that is gone; refuse to start
+    if one is still listening.
+    """
+    if not os.path.exists(path):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        os.unlink(path)
+    else:
+        sys.exit('A ts server is already listening on {}'.format(path))
+    finally:
+        probe.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve ts.py requests on a Unix domain socket')
+    parser.add_argument('--socket', default=None, help='Defaults to {}.'.format(default_socket()))
+    parser.add_argument('--max-clients', type=int, default=MAX_CLIENTS,
+        help='Connections served at once. Defaults to {}.'.format(MAX_CLIENTS))
+    parser.add_argument('--jobs', type=int, default=JOBS, help='Requests run at once. Defaults to {}.'.format(JOBS))
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    path = args.socket or default_socket()
+    server = UnixServer(path, Server(jobs=args.jobs), max_clients=args.max_clients)
+    logger.info('Listening on %s', path)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)